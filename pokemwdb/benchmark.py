@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+"""Benchmarks for the wikitext parser
+
+Synthetic mode parses generated wikitext of increasing size for several
+(some pathological) shapes, and reports the parse time, the number of
+objects the tree keeps alive, and the scaling exponent: the slope of
+log(time) against log(size). 1 means linear; 2 means quadratic.
+
+Corpus mode parses every page in a wiki's cache.
+
+Pokedex mode counts the database queries made while computing what the
+species templates of a wiki should contain, with and without preloading
+(see the preload module).
+
+Results can be saved as a baseline and compared against it later;
+cases that got noticeably slower, or scale worse, are flagged.
+"""
+from __future__ import unicode_literals, division
+
+import sys
+import gc
+import json
+import math
+import timeit
+import argparse
+
+from pokemwdb import wikiparse
+from pokemwdb.wikichecker import WikiChecker
+
+def flat(n):
+    """Ordinary article: sections with text and small templates"""
+    return ''.join(
+            '== Section %s ==\n'
+            'Text with a {{tt|tooltip|in it}} and a {{link|target}}.\n'
+            '{{Infobox|name=Thing %s|type=Normal|number=%s}}\n' % (i, i, i)
+        for i in range(n))
+
+def nested(n):
+    """Templates nested n deep"""
+    return '{{a|' * n + 'x' + '}}' * n
+
+def unterminated(n):
+    """n templates that are never closed"""
+    return 'text {{a|b=c ' * n
+
+def pipes(n):
+    """One template with n parameters"""
+    return '{{Learnset|' + '|'.join('%s|move %s' % (i, i) for i in range(n)) + '}}'
+
+def headings(n):
+    """n headings on alternating levels and no templates"""
+    return ''.join('%s h %s %s\ntext\n' % ('=' * (i % 5 + 1), i, '=' * (i % 5 + 1))
+            for i in range(n))
+
+def tables(n):
+    """A table with n rows, and a row of templates in each"""
+    return ('{| class="wikitable"\n! Level !! Move\n' +
+            ''.join('|-\n| %s || {{m|Move %s}} || [[A|b]]\n' % (i, i)
+                for i in range(n)) +
+            '|}\n')
+
+generators = dict(flat=flat, nested=nested, unterminated=unterminated,
+        pipes=pipes, headings=headings, tables=tables)
+
+def measure(text, repeat=3):
+    """Return (best parse time, number of objects kept alive by the tree)"""
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        wikiparse.wikiparse(text)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    gc.collect()
+    before = len(gc.get_objects())
+    tree = wikiparse.wikiparse(text)
+    objects = len(gc.get_objects()) - before
+    del tree
+    return best, objects
+
+def scaling_exponent(points):
+    """Least-squares slope of log(time) against log(size)"""
+    logs = [(math.log(size), math.log(max(time, 1e-9)))
+            for size, time in points]
+    mean_x = sum(x for x, y in logs) / len(logs)
+    mean_y = sum(y for x, y in logs) / len(logs)
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in logs)
+    denominator = sum((x - mean_x) ** 2 for x, y in logs)
+    return numerator / denominator
+
+def run_synthetic(names, base=100, steps=5):
+    results = {}
+    for name in names:
+        generator = generators[name]
+        points = []
+        print '%s: %s' % (name, generator.__doc__)
+        for step in range(steps):
+            text = generator(base * 2 ** step)
+            seconds, objects = measure(text)
+            points.append((len(text), seconds))
+            print '  %9d chars  %8.4f s  %8d objects  %6.2f us/char' % (
+                    len(text), seconds, objects, seconds / len(text) * 1e6)
+        exponent = scaling_exponent(points)
+        print '  scaling exponent: %.2f' % exponent
+        size, seconds = points[-1]
+        results[name] = dict(exponent=exponent, us_per_char=seconds / size * 1e6)
+    return results
+
+def run_corpus(url_base, db_url=None, slowest=10):
+    from pokemwdb.wikicache import WikiCache, Page
+
+    cache = WikiCache(url_base, db_url=db_url, update=False)
+    query = cache.session.query(Page.title, Page.contents)
+    query = query.filter(Page.wiki_id == url_base)
+    query = query.filter(Page.contents != None)
+    timings = []
+    for title, contents in query:
+        seconds, objects = measure(contents, repeat=1)
+        timings.append((seconds, title, len(contents), objects))
+    if not timings:
+        print 'No cached pages for %s' % url_base
+        return {}
+    total_seconds = sum(t[0] for t in timings)
+    total_chars = sum(t[2] for t in timings)
+    print '%s pages, %s chars, %.2f s total, %.2f us/char' % (
+            len(timings), total_chars, total_seconds,
+            total_seconds / total_chars * 1e6)
+    exponent = scaling_exponent([(size, seconds)
+            for seconds, title, size, objects in timings if size])
+    print 'scaling exponent across pages: %.2f' % exponent
+    print 'Slowest pages:'
+    for seconds, title, size, objects in sorted(timings, reverse=True)[:slowest]:
+        print '  %8.4f s  %8d chars  %8d objects  %s' % (
+                seconds, size, objects, title)
+    return dict(corpus=dict(exponent=exponent,
+            us_per_char=total_seconds / total_chars * 1e6))
+
+class _BenchmarkChecker(WikiChecker):
+    """A WikiChecker without a wiki, for the database access of templates"""
+    def __init__(self, session):
+        self.session = session
+
+class _BenchmarkArticle(object):
+    """Enough of an ArticleChecker for TemplateTemplates, without a wiki"""
+    def __init__(self, session):
+        self.checker = _BenchmarkChecker(session)
+
+def run_pokedex(wiki_name, preload):
+    """Compute all expected species template values; count the queries"""
+    from pokedex.db import connect, tables
+    from pokemwdb import preload as preload_module
+    from pokemwdb.wikichecker import find_template
+
+    wiki = __import__('pokemwdb.' + wiki_name, fromlist=['PokemonInfobox'])
+    # Pokémon Central's templates need its module-level session
+    session = getattr(wiki, 'session', None) or connect()
+    session.expire_all()
+    article = _BenchmarkArticle(session)
+    # Loaded once per run, and cached on disk; not what's measured here
+    article.checker.facts
+    templates = []
+    for template_class in wiki.PokemonInfobox, wiki.PokemonPrevNextHead:
+        tree = wikiparse.wikiparse('{{%s}}' % template_class.__name__)
+        templates.append((template_class,
+                find_template(tree, template_class.__name__)))
+    start = timeit.default_timer()
+    with preload_module.count_queries(session) as statements:
+        query = session.query(tables.PokemonSpecies).order_by(
+                tables.PokemonSpecies.id)
+        if preload:
+            query = preload_module.preload_species(query)
+        num_species = 0
+        for species in query:
+            num_species += 1
+            for template_class, template in templates:
+                template_class(article, template, species=species).check()
+    seconds = timeit.default_timer() - start
+    print '%s, %s preloading: %s species, %s queries, %.2f s' % (
+            wiki_name, 'with' if preload else 'without', num_species,
+            len(statements), seconds)
+    return dict(queries=len(statements), seconds=seconds)
+
+def compare(results, baseline, tolerance=0.25, exponent_tolerance=0.2):
+    """Return a list of messages about cases that regressed"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        try:
+            base = baseline[name]
+        except KeyError:
+            continue
+        if result['us_per_char'] > base['us_per_char'] * (1 + tolerance):
+            regressions.append('%s: %.2f us/char, baseline %.2f' % (
+                    name, result['us_per_char'], base['us_per_char']))
+        if result['exponent'] > base['exponent'] + exponent_tolerance:
+            regressions.append('%s: scaling exponent %.2f, baseline %.2f' % (
+                    name, result['exponent'], base['exponent']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*', default=sorted(generators),
+            help='synthetic cases to run (default: all of %s)' %
+                ', '.join(sorted(generators)))
+    parser.add_argument('--base', type=int, default=100,
+            help='size of the smallest synthetic input')
+    parser.add_argument('--steps', type=int, default=5,
+            help='number of sizes to try; each is double the previous one')
+    parser.add_argument('--corpus', metavar='URL_BASE',
+            help='parse all cached pages of this wiki instead')
+    parser.add_argument('--db', help='cache database (see WikiCache)')
+    parser.add_argument('--pokedex', metavar='WIKI',
+            choices=['bulbapedia', 'pokemoncentral'],
+            help='count pokedex queries for the species templates of this '
+                'wiki (bulbapedia or pokemoncentral) instead')
+    parser.add_argument('--baseline', metavar='FILE',
+            help='compare results with this baseline file')
+    parser.add_argument('--save', metavar='FILE',
+            help='save results to this file, to use as a baseline')
+    args = parser.parse_args(argv)
+
+    if args.pokedex:
+        before = run_pokedex(args.pokedex, preload=False)
+        after = run_pokedex(args.pokedex, preload=True)
+        print 'queries: %s before, %s after' % (
+                before['queries'], after['queries'])
+        return 0
+    elif args.corpus:
+        results = run_corpus(args.corpus, args.db)
+    else:
+        results = run_synthetic(args.cases, args.base, args.steps)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline)
+        for message in regressions:
+            print 'REGRESSION:', message
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,8 +8,11 @@ import re
 
 from pokemwdb.wikicache import WikiCache
 from pokemwdb.wikichecker import (WikiChecker, ArticleChecker,
-        TemplateTemplate, normalize, missing_on, param_name, ignored, checker)
+        TemplateTemplate, normalize, missing_on, param_name, ignored, checker,
+        main)
 from pokemwdb import wikiparse
+from pokemwdb.preload import preload_species, MoveIndexes
+from pokemwdb.changelog import MoveTimeline
 
 class PokemonPrevNextHead(TemplateTemplate):
     def _init(self):
@@ -57,8 +60,8 @@ def remove_simple_html_comment(string):
 
 class PokemonInfobox(TemplateTemplate):
     def _init(self):
-        self.dexnums = dict((dn.pokedex.identifier, dn.pokedex_number) for dn
-                in self.species.dex_numbers)
+        self.facts = self.checker.checker.facts.species[self.species.id]
+        self.dexnums = self.facts.dex_numbers
 
     def name(self, v): return self.species.name
 
@@ -134,20 +137,19 @@ class PokemonInfobox(TemplateTemplate):
     @param_name('height-ftin')
     @normalize(lambda s: s.replace('′', "'").replace('″', '"').replace(' ', ''))  # XXX
     def height_ftin(self, v): return '''{0}'{1:02}"'''.format(*divmod(
-            int(round(self.species.default_pokemon.height * 3.937)), 12))
+            self.facts.height_inches, 12))
 
     @param_name('height-m')
     @normalize(lambda n: float(n))  # XXX
-    def height_m(self, v): return self.species.default_pokemon.height / 10.
+    def height_m(self, v): return self.facts.height / 10.
 
     @param_name('weight-lbs')
     @normalize(lambda n: float(n))  # XXX
-    def weight_lbs(self, v): return int(round(
-            self.species.default_pokemon.weight * 2.20462262)) / 10.
+    def weight_lbs(self, v): return self.facts.weight_tenth_pounds / 10.
 
     @param_name('weight-kg')
     @normalize(lambda n: float(n))  # XXX
-    def weight_kg(self, v): return self.species.default_pokemon.weight / 10.
+    def weight_kg(self, v): return self.facts.weight / 10.
 
 
     def abilityn(self, v): return len(self.species.default_pokemon.abilities)
@@ -193,7 +195,7 @@ class PokemonInfobox(TemplateTemplate):
 
     def _stat(stat_name):
         def _stat_check(self, v):
-            val = self.species.default_pokemon.stat(stat_name).effort
+            val = self.facts.efforts.get(stat_name)
             if val:
                 return val
             else:
@@ -208,33 +210,20 @@ class PokemonInfobox(TemplateTemplate):
     evsp = _stat('speed')
 
     expyield = ignored()  # XXX
-    def lv100exp(self, v): return group_digits(
-            self.species.growth_rate.max_experience)
+    def lv100exp(self, v): return group_digits(self.facts.max_experience)
 
-    def gendercode(self, v):
-        return {
-                -1: 255,
-                0: 0,
-                1: 31,
-                2: 63,
-                #3: 
-                4: 127,
-                #5: 
-                6: 191,
-                7: 223,
-                8: 254,
-            }[self.species.gender_rate]
-
-    def catchrate(self, v): return self.species.capture_rate
-    def body(self, v): return format(self.species.shape_id, '02')
+    def gendercode(self, v): return self.facts.gender_code
+
+    def catchrate(self, v): return self.facts.capture_rate
+    def body(self, v): return format(self.facts.shape_id, '02')
     def color(self, v): return self.species.color.name
-    def generation(self, v): return self.species.generation_id
+    def generation(self, v): return self.facts.generation_id
 
     pokefordex = ignored()
     footnotes = ignored()
 
     # Old/undocumented params
-    def eggcycles(self, v): return self.species.hatch_counter
+    def eggcycles(self, v): return self.facts.hatch_counter
     pron = ignored()
     size = ignored()
     disptype = ignored()
@@ -253,14 +242,13 @@ mdash = ('—', '&mdash;', 'N/A')
 
 class MoveInfobox(TemplateTemplate):
     def _init(self):
+        self.facts = self.checker.checker.facts.moves[self.move.id]
+        self.timeline = MoveTimeline(self.move, self.dball(tables.VersionGroup))
         self.flags = set(f.identifier for f in self.move.flags)
 
-        self.machines = dict((m.version_group.generation_id, m.machine_number)
-                for m in self.checker.checker.session.query(tables.Machine)
-                        .filter_by(move_id=self.move.id))
-
-        self.tutors = set(pm.version_group.versions[0].identifier for pm in
-                self.move.pokemon_moves if pm.method.identifier == 'tutor')
+        move_indexes = self.checker.checker.move_indexes
+        self.machines = move_indexes.machines.get(self.move.id, {})
+        self.tutors = move_indexes.tutors.get(self.move.id, set())
 
     def n(self, v): return self.move.id if self.move.id < 10000 else 1000
 
@@ -281,29 +269,17 @@ class MoveInfobox(TemplateTemplate):
         gens = '0 I II III IV V'.split()
         def wrapper(func):
             def get(self, v):
-                history = dict((c.changed_in, getattr(c, attrname)) for
-                        c in self.move.changelog)
-                low = high = self.move.generation_id
                 changes = []
-                for vg in list(self.checker.checker.session.query(tables.VersionGroup)) + [None]:
-                    try:
-                        new_value = history[vg]
-                    except KeyError:
-                        new_value = None
-                    if new_value is None:
-                        pass
+                # The last segment is the current value
+                for value, low, high in self.timeline.segments(attrname)[:-1]:
+                    if low == high:
+                        geninfo = gens[high]
                     else:
-                        if low == high:
-                            geninfo = gens[high]
-                        else:
-                            geninfo = '%s to %s' % (gens[low], gens[high])
-                        value = func(new_value)
-                        if isinstance(value, tuple):
-                            value = value[0]
-                        low = vg.generation_id
-                        changes.append('%s in Generation %s' % (value, geninfo))
-                    if vg:
-                        high = vg.generation_id
+                        geninfo = '%s to %s' % (gens[low], gens[high])
+                    value = func(value)
+                    if isinstance(value, tuple):
+                        value = value[0]
+                    changes.append('%s in Generation %s' % (value, geninfo))
                 value = func(getattr(self.move, attrname))
                 if changes:
                     if isinstance(value, tuple):
@@ -316,7 +292,7 @@ class MoveInfobox(TemplateTemplate):
 
     @_changelog('pp')
     def basepp(pp): return pp or mdash
-    def maxpp(self, v): return self.move.pp * 8 // 5 if self.move.pp else mdash
+    def maxpp(self, v): return self.facts.max_pp or mdash
 
     @_changelog('accuracy')
     def accuracy(accuracy):
@@ -326,12 +302,12 @@ class MoveInfobox(TemplateTemplate):
             return accuracy
 
     def priority(self, v):
-        if not self.move.priority:
+        if not self.facts.priority:
             return ('' or None)
-        elif self.move.priority > 0:
-            return '+%s' % self.move.priority
+        elif self.facts.priority > 0:
+            return '+%s' % self.facts.priority
         else:
-            return self.move.priority
+            return self.facts.priority
 
     @_changelog('power')
     def power(power):
@@ -435,14 +411,14 @@ class MoveInfobox(TemplateTemplate):
     flag7 = ignored()
     flag8 = ignored()
 
-    def gen(self, v): return '0 I II III IV V'.split()[self.move.generation_id]
+    def gen(self, v): return '0 I II III IV V'.split()[self.facts.generation_id]
 
     def damagecategory(self, v):
         return {
                 'physical': 'Physical',
                 'special': 'Special',
                 'non-damaging': 'Status',
-            }[self.move.damage_class.identifier]
+            }[self.facts.damage_class]
 
     def target(self, v):
         return {
@@ -460,7 +436,7 @@ class MoveInfobox(TemplateTemplate):
                 'opponents-field': 'foes',
                 'ally': 'ally',
                 'user-or-ally': 'selfadjacentally',
-            }[self.move.target.identifier]
+            }[self.facts.target]
 
     cdesc = ignored()  # XXX
     scdesc = ignored()  # XXX
@@ -517,15 +493,22 @@ class BulbapediaChecker(WikiChecker):
     def __init__(self):
         WikiChecker.__init__(self)
         self.session = connect()
+        self.move_indexes = MoveIndexes(self.session)
+
+    def reopen(self):
+        WikiChecker.reopen(self)
+        self.session = connect()
+        self.move_indexes = MoveIndexes(self.session)
 
     def checkers(self):
-        for species in self.session.query(tables.PokemonSpecies).order_by(tables.PokemonSpecies.id):
-            pass
+        species_query = self.session.query(tables.PokemonSpecies).order_by(tables.PokemonSpecies.id)
+        species_query = preload_species(species_query)
+        for species in self.selection.species(species_query):
             yield CheckPokemonNavigation(self, species)
             yield CheckPokemonInfobox(self, species)
-        for move in self.session.query(tables.Move).join(tables.Move.names_local).order_by(tables.Move.names_table.name):
-            pass
+        move_query = self.session.query(tables.Move).join(tables.Move.names_local).order_by(tables.Move.names_table.name)
+        for move in self.selection.moves(move_query):
             yield CheckMoveInfobox(self, move)
 
 if __name__ == '__main__':
-    BulbapediaChecker().check()
+    main(BulbapediaChecker)
@@ -0,0 +1,63 @@
+# Encoding: UTF-8
+"""Values of a move's attributes over the version groups
+
+The pokedex keeps a move's current values, and a changelog: each entry
+gives the values a move had before the version group it's `changed_in`
+(None for attributes that didn't change). MoveTimeline works out, once
+per move, the value of each attribute in each version group, and the
+ranges of generations each value held for.
+"""
+from __future__ import unicode_literals
+
+class MoveTimeline(object):
+    """The values of a move's attributes in each version group
+
+    :param move: The move
+    :param version_groups: All version groups, oldest first
+    """
+    attributes = ['type', 'power', 'pp', 'accuracy', 'effect_chance',
+            'move_effect']
+
+    def __init__(self, move, version_groups):
+        self.move = move
+        positions = dict((version_group, position) for position, version_group
+                in enumerate(version_groups))
+        # Newest first
+        changes = sorted(move.changelog,
+                key=lambda change: positions[change.changed_in], reverse=True)
+        # attribute -> {version group: value}
+        self.values = {}
+        for attribute in self.attributes:
+            value = getattr(move, attribute)
+            values = self.values[attribute] = {}
+            pending = list(changes)
+            for position in reversed(range(len(version_groups))):
+                while pending and positions[pending[0].changed_in] > position:
+                    old_value = getattr(pending.pop(0), attribute)
+                    if old_value is not None:
+                        value = old_value
+                values[version_groups[position]] = value
+        # Version groups since the move's introduction, oldest first
+        self.version_groups = [version_group
+                for version_group in version_groups
+                if version_group.generation_id >= move.generation_id]
+
+    def value_in(self, attribute, version_group):
+        """The value of the attribute in the version group"""
+        return self.values[attribute][version_group]
+
+    def segments(self, attribute):
+        """Return [(value, first generation, last generation)], oldest first
+
+        Each value is given with the generations it held for, since the
+        move's introduction. The last one is the current value.
+        """
+        segments = []
+        for version_group in self.version_groups:
+            value = self.values[attribute][version_group]
+            generation = version_group.generation_id
+            if segments and segments[-1][0] == value:
+                segments[-1][2] = generation
+            else:
+                segments.append([value, generation, generation])
+        return [tuple(segment) for segment in segments]
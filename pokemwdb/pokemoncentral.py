@@ -9,11 +9,12 @@ import re
 from pokemwdb.wikicache import WikiCache
 from pokemwdb.wikichecker import (WikiChecker, ArticleChecker,
         TemplateTemplate, normalize, missing_on, param_name, ignored, checker,
-        WrongTemplateParameter)
+        WrongTemplateParameter, main)
 from pokemwdb import wikiparse
+from pokemwdb.preload import preload_species, MoveIndexes
+from pokemwdb.changelog import MoveTimeline
 
 session = connect()
-en = session.query(tables.Language).filter_by(identifier='en').one()
 
 def _coleot(value):
     return {'Coleottero': ('Coleot', 'Coleottero')}.get(value, value)  # XXX
@@ -40,11 +41,13 @@ class PokemonPrevNextHead(TemplateTemplate):
         self.default_pokemon = self.species.default_pokemon
 
     @normalize(wikiparse.make_wikiname)
-    def prec(self, v): return self.prev.name_map[en]
+    def prec(self, v):
+        return self.prev.name_map[self.dbget(tables.Language, 'en')]
     def numprec(self, v): return format(self.prev.id, '03')
 
     @normalize(wikiparse.make_wikiname)
-    def succ(self, v): return self.next.name_map[en]
+    def succ(self, v):
+        return self.next.name_map[self.dbget(tables.Language, 'en')]
     def numsucc(self, v): return format(self.next.id, '03')
 
     @normalize(wikiparse.make_wikiname)
@@ -56,10 +59,11 @@ class PokemonPrevNextHead(TemplateTemplate):
 
 class PokemonInfobox(TemplateTemplate):
     def _init(self):
-        self.dexnums = dict((dn.pokedex.identifier, dn.pokedex_number) for dn
-                in self.species.dex_numbers)
+        self.facts = self.checker.checker.facts.species[self.species.id]
+        self.dexnums = self.facts.dex_numbers
 
-    def nome(self, v): return self.species.name_map[en]
+    def nome(self, v):
+        return self.species.name_map[self.dbget(tables.Language, 'en')]
 
     def nomejap(self, v):
         return self.species.name_map[self.dbget(tables.Language, 'ja')]
@@ -133,23 +137,22 @@ class PokemonInfobox(TemplateTemplate):
 
     @param_name('height-ftin')
     def height_ftin(self, v): return '''{0}'{1:02}"'''.format(*divmod(
-            int(round(self.species.default_pokemon.height * 3.937)), 12))
+            self.facts.height_inches, 12))
 
     @param_name('height-m')
     @normalize(eufloat)  # XXX
     def height_m(self, v): return unicode(
-            self.species.default_pokemon.height / 10.).replace('.', ',')
+            self.facts.height / 10.).replace('.', ',')
 
     @param_name('peso-lbs')
     @normalize(eufloat)  # XXX
-    def weight_lbs(self, v): return unicode(int(round(
-            self.species.default_pokemon.weight * 2.20462262)) / 10.
-            ).replace('.', ',')
+    def weight_lbs(self, v): return unicode(
+            self.facts.weight_tenth_pounds / 10.).replace('.', ',')
 
     @param_name('peso-kg')
     @normalize(eufloat)  # XXX
     def weight_kg(self, v): return unicode(
-            self.species.default_pokemon.weight / 10.).replace('.', ',')
+            self.facts.weight / 10.).replace('.', ',')
 
 
     @param_name('nabilità')
@@ -200,7 +203,7 @@ class PokemonInfobox(TemplateTemplate):
 
     def _stat(stat_name):
         def _stat_check(self, v):
-            val = self.species.default_pokemon.stat(stat_name).effort
+            val = self.facts.efforts.get(stat_name)
             if val:
                 return val
             else:
@@ -215,32 +218,19 @@ class PokemonInfobox(TemplateTemplate):
     evsp = _stat('speed')
 
     espceduta = ignored()  # XXX (expyield)
-    def lv100exp(self, v): return group_digits(
-            self.species.growth_rate.max_experience)
+    def lv100exp(self, v): return group_digits(self.facts.max_experience)
 
-    def codsesso(self, v):
-        return {
-                -1: 255,
-                0: 0,
-                1: 31,
-                2: 63,
-                #3: 
-                4: 127,
-                #5: 
-                6: 191,
-                7: 223,
-                8: 254,
-            }[self.species.gender_rate]
-
-    def tassocattura(self, v): return self.species.capture_rate
-    def body(self, v): return format(self.species.shape_id, '02')
+    def codsesso(self, v): return self.facts.gender_code
+
+    def tassocattura(self, v): return self.facts.capture_rate
+    def body(self, v): return format(self.facts.shape_id, '02')
     def colore(self, v): return self.species.color.name
-    def generazione(self, v): return self.species.generation_id
+    def generazione(self, v): return self.facts.generation_id
 
     pokefordex = ignored()
     footnotes = ignored()
 
-    def cicliuovo(self, v): return self.species.hatch_counter
+    def cicliuovo(self, v): return self.facts.hatch_counter
 
     odex = ignored()
     fdex = ignored()
@@ -256,14 +246,13 @@ mdash = ('—', '&mdash;', 'N/A')
 
 class MoveInfobox(TemplateTemplate):
     def _init(self):
+        self.facts = self.checker.checker.facts.moves[self.move.id]
+        self.timeline = MoveTimeline(self.move, self.dball(tables.VersionGroup))
         self.flags = set(f.identifier for f in self.move.flags)
 
-        self.machines = dict((m.version_group.generation_id, m.machine_number)
-                for m in self.checker.checker.session.query(tables.Machine)
-                        .filter_by(move_id=self.move.id))
-
-        self.tutors = set(pm.version_group.versions[0].identifier for pm in
-                self.move.pokemon_moves if pm.method.identifier == 'tutor')
+        move_indexes = self.checker.checker.move_indexes
+        self.machines = move_indexes.machines.get(self.move.id, {})
+        self.tutors = move_indexes.tutors.get(self.move.id, set())
 
     def name(self, v): return self.move.name
 
@@ -288,29 +277,17 @@ class MoveInfobox(TemplateTemplate):
         param_name(func.__name__ + 'notes')
         attrname = attrname or func.__name__
         def wrapper(self, v):
-            history = dict((c.changed_in, getattr(c, attrname)) for
-                    c in self.move.changelog)
-            low = high = self.move.generation_id
             changes = []
-            for vg in list(self.checker.checker.session.query(tables.VersionGroup)) + [None]:
-                try:
-                    new_value = history[vg]
-                except KeyError:
-                    new_value = None
-                if new_value is None:
-                    pass
+            # The last segment is the current value
+            for value, low, high in self.timeline.segments(attrname)[:-1]:
+                if low == high:
+                    geninfo = 'nella %s' % gens[high]
                 else:
-                    if low == high:
-                        geninfo = 'nella %s' % gens[high]
-                    else:
-                        geninfo = 'dalla %s alla %s' % (gens[low], gens[high])
-                    value = func(None, None, new_value)
-                    if isinstance(value, tuple):
-                        value = value[0]
-                    low = vg.generation_id
-                    changes.append('%s %s generazione' % (value, geninfo))
-                if vg:
-                    high = vg.generation_id
+                    geninfo = 'dalla %s alla %s' % (gens[low], gens[high])
+                value = func(None, None, value)
+                if isinstance(value, tuple):
+                    value = value[0]
+                changes.append('%s %s generazione' % (value, geninfo))
             if changes:
                 return ', '.join(changes)
             else:
@@ -345,12 +322,12 @@ class MoveInfobox(TemplateTemplate):
     powernotes = _changelog(power)
 
     def priority(self, v):
-        if not self.move.priority:
+        if not self.facts.priority:
             return ('' or None)
-        elif self.move.priority > 0:
-            return '+%s' % self.move.priority
+        elif self.facts.priority > 0:
+            return '+%s' % self.facts.priority
         else:
-            return self.move.priority
+            return self.facts.priority
 
     def _flag(self, identifier, true_val=True):
         if (identifier in self.flags) == true_val:
@@ -453,14 +430,14 @@ class MoveInfobox(TemplateTemplate):
             return ('no', None)
     na = ignored()  # XXX
 
-    def gen(self, v): return '0 I II III IV V'.split()[self.move.generation_id]
+    def gen(self, v): return '0 I II III IV V'.split()[self.facts.generation_id]
 
     def damagecategory(self, v):
         return {
                 'physical': 'Fisico',
                 'special': 'Speciale',
                 'non-damaging': 'Stato',
-            }[self.move.damage_class.identifier]
+            }[self.facts.damage_class]
 
     def target(self, v):
         return {
@@ -478,7 +455,7 @@ class MoveInfobox(TemplateTemplate):
                 'opponents-field': 'foes',
                 'ally': 'ally',
                 'user-or-ally': 'selfadjacentally',
-            }[self.move.target.identifier]
+            }[self.facts.target]
 
     cdesc = ignored()
     scdesc = ignored()
@@ -491,7 +468,8 @@ class MoveInfobox(TemplateTemplate):
 
 class PokemonChecker(ArticleChecker):
     def __init__(self, checker, species):
-        ArticleChecker.__init__(self, checker, species.name_map[en])
+        ArticleChecker.__init__(self, checker,
+                species.name_map[checker.dbget(tables.Language, 'en')])
         self.species = species
 
 class CheckPokemonNavigation(PokemonChecker):
@@ -545,17 +523,26 @@ class PCChecker(WikiChecker):
         WikiChecker.__init__(self)
         self.cache.seconds_per_request = 15
         self.session = session#connect()
+        self.move_indexes = MoveIndexes(self.session)
+        self.session.default_language_id = self.session.query(
+                tables.Language).filter_by(identifier='it').one().id
+
+    def reopen(self):
+        WikiChecker.reopen(self)
+        self.session = connect()
+        self.move_indexes = MoveIndexes(self.session)
         self.session.default_language_id = self.session.query(
                 tables.Language).filter_by(identifier='it').one().id
 
     def checkers(self):
-        for species in self.session.query(tables.PokemonSpecies).order_by(tables.PokemonSpecies.id):
+        species_query = self.session.query(tables.PokemonSpecies).order_by(tables.PokemonSpecies.id)
+        species_query = preload_species(species_query)
+        for species in self.selection.species(species_query):
             yield CheckPokemonNavigation(self, species)
             yield CheckPokemonInfobox(self, species)
-            pass
-        for move in self.session.query(tables.Move).join(tables.Move.names_local).order_by(tables.Move.names_table.name):
+        move_query = self.session.query(tables.Move).join(tables.Move.names_local).order_by(tables.Move.names_table.name)
+        for move in self.selection.moves(move_query):
             yield CheckMoveInfobox(self, move)
-            pass
 
 if __name__ == '__main__':
-    PCChecker().check()
+    main(PCChecker)
@@ -8,8 +8,6 @@ import stat
 from textwrap import dedent
 from collections import defaultdict, OrderedDict
 
-from sqlalchemy.orm import joinedload
-
 from pokedex.db import connect, tables, markdown, util
 from lxml import etree
 import termcolor
@@ -17,6 +15,7 @@ from diff_match_patch import diff_match_patch
 
 from pokemwdb.wikicache import WikiCache
 from pokemwdb import wikiparse
+from pokemwdb.changelog import MoveTimeline
 
 
 #stdout = sys.stdout
@@ -81,13 +80,6 @@ def print_wiki_diff(diff, file=None):
             yield side, text
     print_diff(generator(), file, wiki_colorizers)
 
-def named_sections(node):
-    if len(node) == 1 and isinstance(node, list):
-        node = node[0]
-    for subnode in node:
-        if isinstance(subnode, wikiparse.Section) and subnode.header:
-            yield subnode
-
 class LinkExtension(markdown.PokedexLinkExtension):
     def normalized_wiki_title(self, title, category):
         return normalize_article_name(self.correct_wiki_title(title, category))
@@ -187,17 +179,18 @@ def last_in(change, default):
         return version_groups[version_groups.index(change.changed_in) - 1]
 
 def get_move_changelog(move):
+    timeline = MoveTimeline(move, version_groups)
     changelog = OrderedDict()
-    current_changes = current_versions = None
     unchanged = True
-    for version in sorted(move.versions, key=lambda v: v.version_group.order, reverse=True):
-        vg = version.version_group
+    for vg in sorted(timeline.version_groups, key=lambda vg: vg.order, reverse=True):
         changes = OrderedDict()
         for attr in 'type power accuracy pp effect_chance'.split():
-            if getattr(version, attr) != getattr(move, attr):
-                changes[attr] = getattr(version, attr)
-        if version.effect_id != move.effect_id:
-            changes['effect'] = markdown_to_wikitext(version.effect)
+            value = timeline.value_in(attr, vg)
+            if value != getattr(move, attr):
+                changes[attr] = value
+        move_effect = timeline.value_in('move_effect', vg)
+        if move_effect != move.move_effect:
+            changes['effect'] = markdown_to_wikitext(move_effect.effect)
         for change in move.move_effect.changelog:
             if vg.order < change.changed_in.order:
                 changes['effect_change'] = markdown_to_wikitext(change.effect)
@@ -269,11 +262,11 @@ def remove_refs(text):
 def get_effect_diff(section, effect, changelog={}, generation_introduced=None):
     wikitexts = ['== Effect ==']
     wikitexts.append(format_changelog(changelog))
-    section_text = unicode(section)
+    section_text = section.source_text
     section_text = remove_refs(section_text)
     section_text = re.sub(r'\[\[Category:[A-Za-z ]*\]\]', '', section_text)
-    section_text = re.sub(r'\{\{(movestub|StubItem|StubAbility) \| \}\}', '', section_text)
-    section_text = re.sub(r'\{\{[Ii]mported *\| *[A-Za-z]*\}\}', '', section_text)
+    section_text = re.sub(r'\{\{ *(movestub|StubItem|StubAbility) *(\| *)?\}\}', '', section_text)
+    section_text = re.sub(r'\{\{ *[Ii]mported *\| *[A-Za-z]* *\}\}', '', section_text)
     section_text = re.sub(r' *\{\{verify[^}]*\}\}\n?', '', section_text)
     section_text = section_text.strip()
     wikitext = '\n'.join(wikitexts)
@@ -283,29 +276,23 @@ def get_effect_diff(section, effect, changelog={}, generation_introduced=None):
         return make_diff(section_text, wikitext)
 
 def analyze_move(article, move):
-    for section in named_sections(article):
-        header_name = section.header.name.strip()
-        if header_name == 'Effect':
-            return get_effect_diff(section, move.effect,
-                get_move_changelog(move), move.generation)
-    else:
+    section = wikiparse.find_section(article, 'Effect')
+    if section is None:
         return False
+    return get_effect_diff(section, move.effect,
+        get_move_changelog(move), move.generation)
 
 def analyze_ability(article, ability):
-    for section in named_sections(article):
-        header_name = section.header.name.strip()
-        if header_name == 'Effect':
-            return get_effect_diff(section, ability.effect)
-    else:
+    section = wikiparse.find_section(article, 'Effect')
+    if section is None:
         return False
+    return get_effect_diff(section, ability.effect)
 
 def analyze_item(article, item):
-    for section in named_sections(article):
-        header_name = section.header.name.strip()
-        if header_name == 'Effect':
-            return get_effect_diff(section, item.effect)
-    else:
+    section = wikiparse.find_section(article, 'Effect')
+    if section is None:
         return False
+    return get_effect_diff(section, item.effect)
 
 def get_wikitext(name, page_type):
     wikitext = wiki.get('%s (%s)' % (name, page_type), follow_redirect=True)
@@ -399,17 +386,18 @@ def main():
                 good_articles.add(name)
 
         q = session.query(tables.Move)
-        q = q.options(joinedload('versions'))
         #q = q.filter_by(identifier='acid-armor')
-        for move in sorted(q, key=lambda m: m.name):
-            wikitext = get_wikitext(move.name, 'move')
-            article = wikiparse.wikiparse(wikitext)
+        moves = sorted(q, key=lambda m: m.name)
+        articles = wikiparse.parse_pages([(move.name,
+                get_wikitext(move.name, 'move')) for move in moves])
+        for move, (name, article) in zip(moves, articles):
             diff = analyze_move(article, move)
             write_diff(diff, 'moves', move.name)
 
-        for ability in sorted(session.query(tables.Ability), key=lambda m: m.name):
-            wikitext = get_wikitext(ability.name, 'ability')
-            article = wikiparse.wikiparse(wikitext)
+        abilities = sorted(session.query(tables.Ability), key=lambda m: m.name)
+        articles = wikiparse.parse_pages([(ability.name,
+                get_wikitext(ability.name, 'ability')) for ability in abilities])
+        for ability, (name, article) in zip(abilities, articles):
             diff = analyze_ability(article, ability)
             write_diff(diff, 'abilities', ability.name)
 
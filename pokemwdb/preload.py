@@ -0,0 +1,280 @@
+# Encoding: UTF-8
+"""Eager loading of the pokedex rows that checkers read
+
+Checkers read species through lazy relationships: types, abilities, stats,
+dex numbers, names and so on. Lazily, that's a few queries per species
+and relationship. preload_species() adds loader options to a species
+query, so that all of those are loaded in a fixed number of queries,
+one per relationship, whatever the number of species. After that, the
+checkers read from objects already in the session.
+
+The relationships differ between pokedex versions; paths this version
+doesn't have are skipped.
+
+MoveIndexes holds the machines and tutors of all moves, which would
+otherwise take a query, or loading all of a move's Pokémon moves, per move.
+
+ExpectedFacts is a table of the facts about species and moves that the
+wikis share, computed a column at a time from a few queries, and cached
+on disk for as long as neither the pokedex nor this module change. The
+checkers of each wiki only format them.
+"""
+from __future__ import unicode_literals
+
+import os
+import contextlib
+import collections
+import cPickle as pickle
+
+from sqlalchemy import event
+from sqlalchemy.orm import subqueryload_all
+
+from pokedex.db import tables
+
+# What PokemonInfobox and PokemonPrevNextHead use, on both wikis
+species_paths = [
+        'names_local',
+        'name_map',
+        'dex_numbers.pokedex',
+        'egg_groups.names_local',
+        'growth_rate',
+        'color.names_local',
+        'default_pokemon.types.names_local',
+        'default_pokemon.abilities.names_local',
+        'default_pokemon.dream_ability.names_local',
+        'default_pokemon.hidden_ability.names_local',
+        'default_pokemon.stats.stat',
+    ]
+
+def loader_options(cls, paths):
+    """Return subqueryload options for the paths `cls` has"""
+    options = []
+    for path in paths:
+        target = cls
+        for name in path.split('.'):
+            prop = getattr(getattr(target, name, None), 'property', None)
+            if not hasattr(prop, 'mapper'):
+                break
+            target = prop.mapper.class_
+        else:
+            options.append(subqueryload_all(path))
+    return options
+
+def preload_species(query):
+    """Make a query of PokemonSpecies load what the checkers need at once
+
+    All species are loaded when the query is first iterated.
+    """
+    return query.options(*loader_options(tables.PokemonSpecies, species_paths))
+
+class MoveIndexes(object):
+    """Machines and tutors of all moves, each loaded at first use
+
+    A WikiChecker keeps one for its session, for the whole run.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def machines(self):
+        """{move ID: {generation ID: machine number}}
+
+        If a move has several machines in a generation, the one of the last
+        version group is given.
+        """
+        try:
+            return self._machines
+        except AttributeError:
+            pass
+        query = self.session.query(tables.Machine.move_id,
+                tables.VersionGroup.generation_id,
+                tables.Machine.machine_number)
+        query = query.join(tables.Machine.version_group)
+        query = query.order_by(tables.Machine.version_group_id,
+                tables.Machine.machine_number)
+        machines = self._machines = collections.defaultdict(dict)
+        for move_id, generation_id, machine_number in query:
+            machines[move_id][generation_id] = machine_number
+        return machines
+
+    @property
+    def tutors(self):
+        """{move ID: set of identifiers of the first versions of the version
+        groups where the move is tutored}
+        """
+        try:
+            return self._tutors
+        except AttributeError:
+            pass
+        first_versions = dict((version_group.id,
+                    version_group.versions[0].identifier)
+                for version_group in self.session.query(tables.VersionGroup))
+        query = self.session.query(tables.PokemonMove.move_id,
+                tables.PokemonMove.version_group_id)
+        query = query.join(tables.PokemonMove.method)
+        query = query.filter(tables.PokemonMoveMethod.identifier == 'tutor')
+        query = query.distinct()
+        tutors = self._tutors = collections.defaultdict(set)
+        for move_id, version_group_id in query:
+            tutors[move_id].add(first_versions[version_group_id])
+        return tutors
+
+# Gender rate (eighths female, -1 for genderless) to the 0-255 gender code
+gender_codes = {-1: 255, 0: 0, 1: 31, 2: 63, 4: 127, 6: 191, 7: 223, 8: 254}
+
+class FactTable(object):
+    """Columns of facts about things, one row per ID
+
+    `columns` maps column names to lists of the same length; the 'id'
+    column gives the IDs. Rows are looked up by ID, and read as attributes.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.positions = dict((id, position)
+                for position, id in enumerate(columns['id']))
+
+    def __getitem__(self, id):
+        return FactRow(self, self.positions[id])
+
+    def __len__(self):
+        return len(self.positions)
+
+class FactRow(object):
+    __slots__ = ['table', 'position']
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __getattr__(self, name):
+        try:
+            column = self.table.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+        return column[self.position]
+
+class ExpectedFacts(object):
+    """Wiki-independent expected facts about all species and moves
+
+    Has a FactTable each for `species` and `moves`. Use load() to get one.
+    """
+    def __init__(self, species, moves):
+        self.species = species
+        self.moves = moves
+
+    @classmethod
+    def load(cls, session, key, path):
+        """Load the facts cached at `path`, or build and cache them
+
+        The cache is used only if it was made with the same key, which
+        should change along with the pokedex and the code that builds the
+        facts; see WikiChecker.facts. If the key is None, nothing is cached.
+        """
+        try:
+            with open(path, 'rb') as cache_file:
+                cached_key, columns = pickle.load(cache_file)
+        except Exception:
+            # Missing or truncated, or pickled by code that has changed
+            # since: unpickling can fail in many ways. Build the facts anew.
+            pass
+        else:
+            if key is not None and cached_key == key:
+                return cls(*[FactTable(c) for c in columns])
+        columns = build_species_facts(session), build_move_facts(session)
+        if key is not None:
+            # Other processes may read the file while it's written
+            temporary_path = '%s.%s' % (path, os.getpid())
+            with open(temporary_path, 'wb') as cache_file:
+                pickle.dump((key, columns), cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary_path, path)
+        return cls(*[FactTable(c) for c in columns])
+
+def build_species_facts(session):
+    """Return columns of facts about all species, for a FactTable"""
+    query = session.query(tables.PokemonSpecies.id,
+            tables.PokemonSpecies.generation_id,
+            tables.PokemonSpecies.capture_rate,
+            tables.PokemonSpecies.shape_id,
+            tables.PokemonSpecies.hatch_counter,
+            tables.PokemonSpecies.gender_rate,
+            tables.GrowthRate.max_experience,
+            tables.Pokemon.id,
+            tables.Pokemon.height,
+            tables.Pokemon.weight)
+    query = query.join(tables.PokemonSpecies.growth_rate)
+    query = query.join(tables.PokemonSpecies.default_pokemon)
+    query = query.order_by(tables.PokemonSpecies.id)
+    rows = query.all()
+    (ids, generation_ids, capture_rates, shape_ids, hatch_counters,
+            gender_rates, max_experiences, pokemon_ids, heights,
+            weights) = zip(*rows) if rows else [()] * 10
+    columns = dict(id=list(ids), generation_id=list(generation_ids),
+            capture_rate=list(capture_rates), shape_id=list(shape_ids),
+            hatch_counter=list(hatch_counters),
+            gender_rate=list(gender_rates),
+            max_experience=list(max_experiences),
+            height=list(heights), weight=list(weights))
+    columns['gender_code'] = [gender_codes.get(rate) for rate in gender_rates]
+    columns['height_inches'] = [int(round(height * 3.937))
+            for height in heights]
+    columns['weight_tenth_pounds'] = [int(round(weight * 2.20462262))
+            for weight in weights]
+
+    dex_numbers = collections.defaultdict(dict)
+    query = session.query(tables.PokemonDexNumber.species_id,
+            tables.Pokedex.identifier, tables.PokemonDexNumber.pokedex_number)
+    query = query.join(tables.PokemonDexNumber.pokedex)
+    for species_id, pokedex, number in query:
+        dex_numbers[species_id][pokedex] = number
+    columns['dex_numbers'] = [dex_numbers[id] for id in ids]
+
+    efforts = collections.defaultdict(dict)
+    query = session.query(tables.PokemonStat.pokemon_id,
+            tables.Stat.identifier, tables.PokemonStat.effort)
+    query = query.join(tables.PokemonStat.stat)
+    for pokemon_id, stat, effort in query:
+        efforts[pokemon_id][stat] = effort
+    columns['efforts'] = [efforts[id] for id in pokemon_ids]
+    return columns
+
+def build_move_facts(session):
+    """Return columns of facts about all moves, for a FactTable"""
+    query = session.query(tables.Move.id, tables.Move.generation_id,
+            tables.Move.pp, tables.Move.priority,
+            tables.MoveDamageClass.identifier, tables.MoveTarget.identifier)
+    query = query.outerjoin(tables.Move.damage_class)
+    query = query.outerjoin(tables.Move.target)
+    query = query.order_by(tables.Move.id)
+    rows = query.all()
+    (ids, generation_ids, pps, priorities, damage_classes,
+            targets) = zip(*rows) if rows else [()] * 6
+    columns = dict(id=list(ids), generation_id=list(generation_ids),
+            pp=list(pps), priority=list(priorities),
+            damage_class=list(damage_classes), target=list(targets))
+    columns['max_pp'] = [pp * 8 // 5 if pp else None for pp in pps]
+    return columns
+
+# engine -> statement lists of count_queries blocks in progress
+_statement_lists = {}
+
+@contextlib.contextmanager
+def count_queries(session):
+    """Count the statements a session executes within the block
+
+    Gives a list; its length is the number of statements so far.
+    """
+    engine = session.get_bind()
+    if engine not in _statement_lists:
+        _statement_lists[engine] = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            for statements in _statement_lists[engine]:
+                statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    statements = []
+    _statement_lists[engine].append(statements)
+    try:
+        yield statements
+    finally:
+        _statement_lists[engine] = [other for other in
+                _statement_lists[engine] if other is not statements]
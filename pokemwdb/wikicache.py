@@ -98,6 +98,10 @@ class WikiCache(object):
     :param limit: The cache will not make more than one request each `limit`
         seconds.
     """
+    read_only = False
+    # Titles per database query; SQLite allows 999 parameters per statement
+    query_batch = 500
+
     def __init__(self, url_base, db_url=None, update=True, sync=False, limit=5):
         if db_url is None:
             db_url = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -141,6 +145,25 @@ class WikiCache(object):
     def log(self, string):
         print string
 
+    def reopen(self, read_only=False):
+        """Connect to the database anew, e.g. in a forked process
+
+        The old connection is left alone, as another process may be using it.
+        If read_only is true, nothing will be fetched from the server any
+        more: pages that aren't up to date give their cached (possibly old or
+        empty) contents.
+        """
+        engine = create_engine(self.session.bind.url)
+        sm = sessionmaker(bind=engine)
+        self.session = sm()
+        self.wiki = self.session.query(Wiki).filter_by(
+                url_base=self.url_base).one()
+        self._needed_metadata = set()
+        self._needed_pages = set()
+        del self._page_object
+        self._page_object = lru_cache(100)(self._page_object)
+        self.read_only = read_only
+
     def _page_query(self):
         return self.session.query(Page)
 
@@ -152,12 +175,16 @@ class WikiCache(object):
         if obj:
             return obj
         else:
-            obj = Page()
-            obj.wiki = self.wiki
-            obj.title = title
-            obj.revision = 0
-            obj.up_to_date = False
-            return obj
+            return self._new_page(title)
+
+    def _new_page(self, title):
+        """Make an object for a page that isn't in the cache yet"""
+        obj = Page()
+        obj.wiki = self.wiki
+        obj.title = title
+        obj.revision = 0
+        obj.up_to_date = False
+        return obj
 
     @property
     def _sleep_seconds(self):
@@ -200,7 +227,12 @@ class WikiCache(object):
         return json.load(result)
 
     def update(self):
-        """Fetch a batch of page changes from the server"""
+        """Fetch a batch of page changes from the server
+
+        Return the titles of pages that changed, or None if the whole cache
+        was invalidated.
+        """
+        changed = set()
         if self.wiki.sync_timestamp is None:
             feed = self.apirequest(action='query', list='recentchanges',
                     rcprop='timestamp', rclimit=1)
@@ -208,6 +240,7 @@ class WikiCache(object):
             self.wiki.sync_timestamp = last_change['timestamp']
             self.invalidate_cache()
             self.synced = True
+            changed = None
         else:
             feed = self.apirequest(action='query', list='recentchanges',
                     rcprop='title|user|timestamp', rclimit=100,
@@ -225,6 +258,7 @@ class WikiCache(object):
                         obj = self._page_object(title)
                         obj.up_to_date = False
                         invalidated.add(title)
+                changed.update(invalidated)
                 try:
                     feed = self.apirequest(action='query', list='recentchanges',
                             rcprop='title|user|timestamp', rclimit=100,
@@ -239,6 +273,22 @@ class WikiCache(object):
                     self.wiki.synced = False
         self.wiki.last_update = datetime.datetime.today()
         self.session.commit()
+        return changed
+
+    def changed_titles(self, since):
+        """Return titles of pages changed on the server since a timestamp
+        """
+        titles = set()
+        continuation = {}
+        while True:
+            feed = self.apirequest(action='query', list='recentchanges',
+                    rcprop='title', rclimit=500, rcend=since, **continuation)
+            titles.update(change['title']
+                    for change in feed['query']['recentchanges'])
+            try:
+                continuation = feed['query-continue']['recentchanges']
+            except KeyError:
+                return titles
 
     def invalidate_cache(self):
         """Invalidate the entire cache
@@ -269,6 +319,68 @@ class WikiCache(object):
                 self._needed_metadata.add(obj)
         self.fetch_pages(force=False)
 
+    def prefetch_pages(self, titles):
+        """Bring the pages with `titles` up to date, with few requests
+
+        Use this instead of mark_needed_pages when all the needed titles are
+        known up front. The cache state of the pages is looked up in bulk,
+        and the pages that aren't up to date are revalidated, and then
+        fetched, in batches packed as full as the request limits allow.
+        """
+        titles = sorted(set(self.normalize_title(t) for t in titles if t))
+        pages = {}
+        for start in range(0, len(titles), self.query_batch):
+            query = self._page_query().filter(Page.wiki_id == self.url_base)
+            query = query.filter(Page.title.in_(
+                    titles[start:start + self.query_batch]))
+            for obj in query:
+                pages[obj.title] = obj
+        stale = set()
+        for title in titles:
+            obj = pages.get(title)
+            if obj is None:
+                obj = self._new_page(title)
+            if not obj.up_to_date:
+                self.session.add(obj)
+                stale.add(obj)
+        if self.read_only or not stale:
+            return
+        self.log('Revalidating %s of %s pages' % (len(stale), len(titles)))
+        self._needed_metadata -= stale
+        for chunk in self._pack(stale, limit=50):
+            self._request_metadata(chunk)
+        needed_pages = self._needed_pages & stale
+        self._needed_pages -= needed_pages
+        for chunk in self._pack(needed_pages):
+            self._request_pages(chunk)
+
+    def _pack(self, pages, limit=20, title_limit=700):
+        """Split pages into as few chunks as the limits allow
+
+        The limits are as in _get_chunk. Each chunk takes the longest
+        remaining titles while they fit, then tops up with the shortest ones.
+        """
+        pages = sorted(pages, key=lambda p: len(p.title))
+        chunks = []
+        shortest, longest = 0, len(pages)
+        while shortest < longest:
+            chunk = set()
+            length = 0
+            while shortest < longest and len(chunk) < limit:
+                if (not chunk or
+                        length + len(pages[longest - 1].title) <= title_limit):
+                    longest -= 1
+                    page = pages[longest]
+                elif length + len(pages[shortest].title) <= title_limit:
+                    page = pages[shortest]
+                    shortest += 1
+                else:
+                    break
+                chunk.add(page)
+                length += len(page.title)
+            chunks.append(chunk)
+        return chunks
+
     def _get_chunk(self, source, limit=20, title_limit=700):
         """Get some pages from a set
 
@@ -305,37 +417,46 @@ class WikiCache(object):
                 wanted = list(self._needed_metadata) + query[:50]
                 chunk, needed = self._get_chunk(wanted, limit=50)
             if needed or force:
-                result = self.apirequest(action='query',
-                        info='lastrevid', prop='revisions', # XXX: will be unnecessary in modern MW
-                        titles='|'.join(p.title for p in chunk))
-                assert 'normalized' not in result['query'], (
-                        result['query']['normalized'])  # XXX: normalization
-                pages_by_title = dict((p.title, p) for p in chunk)
-                for page_info in result['query'].get('pages', {}).values():
-                    page = pages_by_title[page_info['title']]
-                    self.session.add(page)
-                    if 'missing' in page_info:
-                            page.up_to_date = True
-                            page.revision = 0
-                            page.contents = None
-                    else:
-                        revid = page_info['revisions'][0]['revid']
-                        # revid = page_info['lastrevid']  # for the modern MW
-                        if revid != page.revision:
-                            self._needed_pages.add(page)
-                        else:
-                            page.up_to_date = True
+                self._request_metadata(chunk)
                 self._needed_metadata -= chunk
-                self.session.commit()
             else:
                 return
 
+    def _request_metadata(self, chunk):
+        """Revalidate a chunk of pages with one request
+
+        Pages whose revision changed are added to _needed_pages.
+        """
+        result = self.apirequest(action='query',
+                info='lastrevid', prop='revisions', # XXX: will be unnecessary in modern MW
+                titles='|'.join(p.title for p in chunk))
+        assert 'normalized' not in result['query'], (
+                result['query']['normalized'])  # XXX: normalization
+        pages_by_title = dict((p.title, p) for p in chunk)
+        for page_info in result['query'].get('pages', {}).values():
+            page = pages_by_title[page_info['title']]
+            self.session.add(page)
+            if 'missing' in page_info:
+                    page.up_to_date = True
+                    page.revision = 0
+                    page.contents = None
+            else:
+                revid = page_info['revisions'][0]['revid']
+                # revid = page_info['lastrevid']  # for the modern MW
+                if revid != page.revision:
+                    self._needed_pages.add(page)
+                else:
+                    page.up_to_date = True
+        self.session.commit()
+
     def fetch_pages(self, titles=(), force=True):
         """Fetch needed pages from the server.
 
         :param force: If true (default), pages will be fetched.
             Otherwise, the pages might be fetched, or may be left for later.
         """
+        if self.read_only:
+            return
         if titles:
             self.mark_needed_pages(titles)
         self._fetch_metadata(force=force)
@@ -344,33 +465,37 @@ class WikiCache(object):
             if not chunk:
                 return
             elif needed or force:
-                pages_by_title = dict((p.title, p) for p in chunk)
-                dump = self._apirequest_raw(action='query',
-                        export='1', exportnowrap='1',
-                        titles='|'.join(p.title for p in chunk))
-                tree = ElementTree.parse(dump)
-                for elem in tree.getroot():
-                    tag = elem.tag
-                    if tag.endswith('}siteinfo'):
-                        continue
-                    elif tag.endswith('}page'):
-                        revision, = (e for e in elem if e.tag.endswith('}revision'))
-                        pagename, = (e for e in elem if e.tag.endswith('}title'))
-                        text, = (e for e in revision if e.tag.endswith('}text'))
-                        revid, = (e for e in revision if e.tag.endswith('}id'))
-                        page = pages_by_title[pagename.text]
-                        page.up_to_date = True
-                        page.revision = int(revid.text)
-                        page.contents = text.text
-                        self.session.add(page)
-                    else:
-                        print elem, list(elem)
-                        raise ValueError(tag)
+                self._request_pages(chunk)
                 self._needed_pages -= chunk
-                self.session.commit()
             else:
                 return
 
+    def _request_pages(self, chunk):
+        """Fetch the contents of a chunk of pages with one request"""
+        pages_by_title = dict((p.title, p) for p in chunk)
+        dump = self._apirequest_raw(action='query',
+                export='1', exportnowrap='1',
+                titles='|'.join(p.title for p in chunk))
+        tree = ElementTree.parse(dump)
+        for elem in tree.getroot():
+            tag = elem.tag
+            if tag.endswith('}siteinfo'):
+                continue
+            elif tag.endswith('}page'):
+                revision, = (e for e in elem if e.tag.endswith('}revision'))
+                pagename, = (e for e in elem if e.tag.endswith('}title'))
+                text, = (e for e in revision if e.tag.endswith('}text'))
+                revid, = (e for e in revision if e.tag.endswith('}id'))
+                page = pages_by_title[pagename.text]
+                page.up_to_date = True
+                page.revision = int(revid.text)
+                page.contents = text.text
+                self.session.add(page)
+            else:
+                print elem, list(elem)
+                raise ValueError(tag)
+        self.session.commit()
+
     def is_up_to_date(self, title):
         """Test if the article is currently cached & up-to-date."""
         return self._page_object(title).up_to_date
@@ -396,12 +521,21 @@ class WikiCache(object):
         obj = self._page_object(title)
         if not obj.up_to_date:
             self.fetch_pages([title])
-            assert obj.up_to_date
+            assert obj.up_to_date or self.read_only
         if obj.contents is None:
             return default
         else:
             return obj.contents
 
+    def get_revision(self, title):
+        """Return the revision ID of a page's content, or 0 if it's missing
+        """
+        obj = self._page_object(title)
+        if not obj.up_to_date:
+            self.fetch_pages([title])
+            assert obj.up_to_date or self.read_only
+        return obj.revision
+
     def redirect_target(self, title):
         """Get a target redirect
 
@@ -8,6 +8,19 @@ import sys
 import textwrap
 import itertools
 import re
+import argparse
+import multiprocessing
+import hashlib
+import inspect
+import cPickle as pickle
+import collections
+import contextlib
+import json
+import timeit
+import sqlite3
+import heapq
+import tempfile
+import time
 
 from pokemwdb.wikicache import WikiCache
 from pokemwdb import wikiparse
@@ -75,6 +88,134 @@ class MissingArticle(Error):
     argnames = []
     template_name = 'nopage'
 
+class Profile(object):
+    """Collects timings of checkers, articles and template parameters
+
+    Timings are kept by kind and name, e.g. ('param', 'MoveInfobox.pp').
+    The kinds are:
+
+    - 'checker': ArticleChecker classes, including parsing and _init
+    - 'article': single checkers, by article and checker name
+    - 'parse': parsing articles
+    - 'init': TemplateTemplate._init (mostly database queries)
+    - 'param': TemplateTemplate parameters, i.e. the checking methods
+    """
+    kinds = 'checker article parse init param'.split()
+
+    def __init__(self):
+        # (kind, name) -> [number of calls, seconds]
+        self.timings = collections.defaultdict(lambda: [0, 0.0])
+
+    def add(self, kind, name, seconds, calls=1):
+        timing = self.timings[kind, name]
+        timing[0] += calls
+        timing[1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, kind, name):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add(kind, name, timeit.default_timer() - start)
+
+    def update(self, timings):
+        """Add timings of another Profile"""
+        for (kind, name), (calls, seconds) in timings.items():
+            self.add(kind, name, seconds, calls)
+
+    def sorted_timings(self, kind):
+        """Return a list of (seconds, calls, name), slowest first"""
+        return sorted(((seconds, calls, name) for (k, name), (calls, seconds)
+                in self.timings.items() if k == kind), reverse=True)
+
+    def report(self, limit=20):
+        for kind in self.kinds:
+            timings = self.sorted_timings(kind)
+            if not timings:
+                continue
+            print 'Time by %s (%s total):' % (kind, len(timings))
+            for seconds, calls, name in timings[:limit]:
+                print '  %9.3f s  %7d calls  %9.3f ms/call  %s' % (
+                        seconds, calls, seconds / calls * 1000, name)
+
+    def save(self, path):
+        data = dict((kind, [dict(name=name, calls=calls, seconds=seconds)
+                    for seconds, calls, name in self.sorted_timings(kind)])
+                for kind in self.kinds)
+        with open(path, 'w') as profile_file:
+            json.dump(data, profile_file, indent=4, sort_keys=True)
+
+def _format_expected(expected):
+    """Show expected value(s) in an error message"""
+    if not isinstance(expected, tuple):
+        expected = (expected, )
+    shown = []
+    for value in expected:
+        value = 'missing' if value is None else unicode(value).strip()
+        shown.append(value if value else 'empty')
+    return ' or '.join(shown)
+
+class _CheckerPlan(object):
+    """Plan for a parameter that is checked by its own checker function"""
+    def __init__(self, name, checker):
+        self.name = name
+        self.checker = checker
+
+    def run(self, template, t_value):
+        return list(self.checker(template, None, t_value))
+
+class _ExpectedPlan(object):
+    """Plan for a parameter whose method gives the expected value
+
+    The method may return a tuple of acceptable values. The wiki's value
+    is passed through the normalizer, if any, before comparing.
+    """
+    def __init__(self, name, expected, normalizer):
+        self.name = name
+        self.expected = expected
+        self.normalizer = normalizer
+
+    def run(self, template, t_value):
+        expected = self.expected(template, None)
+        if self.normalizer is not None:
+            try:
+                t_value = self.normalizer(t_value)
+            except Exception:
+                return [WrongTemplateParameter(self.name,
+                        _format_expected(expected), t_value)]
+
+        if isinstance(expected, tuple):
+            if t_value is None:
+                match = None in expected
+            else:
+                t_text = unicode(t_value)
+                match = any(unicode(x) == t_text for x in expected)
+        elif type(expected) is unicode and type(t_value) is unicode:
+            match = expected == t_value
+        else:
+            match = unicode(expected) == unicode(t_value)
+
+        if match:
+            return []
+        elif expected is None:
+            return [ExtraTemplateParameter(self.name, t_value)]
+        elif t_value is None:
+            return [MissingTemplateParameter(self.name,
+                    _format_expected(expected))]
+        else:
+            return [WrongTemplateParameter(self.name,
+                    _format_expected(expected), t_value)]
+
+def _compile_param(param):
+    """Make a plan for checking a parameter"""
+    checker = getattr(param, 'checker', None)
+    if checker:
+        return _CheckerPlan(param.name, checker)
+    else:
+        return _ExpectedPlan(param.name, param,
+                getattr(param, 'normalizer', None))
+
 class _TTMeta(type):
     def __new__(cls, name, bases, attrs):
         if name != 'TemplateTemplate':
@@ -91,6 +232,8 @@ class _TTMeta(type):
                     except AttributeError:
                         attrvalue.name = attrname
                         newattrs['params'][attrname] = attrvalue
+            newattrs['_plans'] = dict((param_name, _compile_param(param))
+                    for param_name, param in newattrs['params'].items())
             attrs = newattrs
 
         return super(_TTMeta, cls).__new__(cls, name, bases, attrs)
@@ -105,82 +248,59 @@ class TemplateTemplate(object):
         self.template = template
         self.name = template.string_name
 
-        self._init()
+        profile = self._profile
+        if profile is None:
+            self._init()
+        else:
+            with profile.timed('init', type(self).__name__):
+                self._init()
 
     def _init(self):
         pass
 
+    @property
+    def _profile(self):
+        return getattr(self.checker.checker, 'profile', None)
+
     def check(self):
         errors = []
+        plans = self._plans
         unused_params = set(self.params)
-        number = 1
-        for t_param in self.template.params:
-            if t_param.name:
-                param_name = unicode(t_param.name).strip()
-            else:
-                param_name = unicode(number)
-                number += 1
+        profile = self._profile
+        for param_name, param_value in self.template.param_items:
             try:
-                m_param = self.params[param_name]
+                plan = plans[param_name]
             except KeyError:
-                errors.append(ExtraTemplateParameter(
-                        param_name, unicode(t_param.value).strip()))
+                errors.append(ExtraTemplateParameter(param_name, param_value))
             else:
-                param_value = unicode(t_param.value).strip()
-                errors.extend(self._check_param(m_param, param_value))
+                if profile is None:
+                    errors.extend(plan.run(self, param_value))
+                else:
+                    errors.extend(self._timed_run(profile, plan, param_value))
                 try:
                     unused_params.remove(param_name)
                 except KeyError:
                     errors.append(DuplicateTemplateParameter(param_name, param_value))
         for param in unused_params:
-            errors.extend(self._check_param(self.params[param], None))
-        return errors
-
-    def _check_param(self, m_param, t_value):
-        checker = getattr(m_param, 'checker', None)
-        if checker:
-            for error in checker(self, None, t_value):
-                yield error
-        else:
-            expected = m_param(self, None)
-            if isinstance(expected, tuple):
-                expected_shown = expected
+            if profile is None:
+                errors.extend(plans[param].run(self, None))
             else:
-                expected_shown = (expected, )
-            expected_shown = ('missing' if e is None else e for e in expected_shown)
-            expected_shown = (unicode(e).strip() for e in expected_shown)
-            expected_shown = (e if e else 'empty' for e in expected_shown)
-            expected_shown = ' or '.join(expected_shown)
-
-            normalizer = getattr(m_param, 'normalizer', lambda x: x)
-            try:
-                t_value = normalizer(t_value)
-            except Exception:
-                yield WrongTemplateParameter(m_param.name, expected_shown, t_value)
-                return
-
-            if isinstance(expected, tuple):
-                if t_value is None:
-                    match = None in expected
-                else:
-                    match = unicode(t_value) in (unicode(x) for x in expected)
-            else:
-                match = unicode(expected) == unicode(t_value)
+                errors.extend(self._timed_run(profile, plans[param], None))
+        return errors
 
-            if not match:
-                if expected is None:
-                    yield ExtraTemplateParameter(m_param.name, t_value)
-                elif t_value is None:
-                    yield MissingTemplateParameter(m_param.name, expected_shown)
-                else:
-                    yield WrongTemplateParameter(m_param.name, expected_shown, t_value)
+    def _timed_run(self, profile, plan, t_value):
+        with profile.timed('param', '%s.%s' % (type(self).__name__,
+                plan.name)):
+            return plan.run(self, t_value)
 
     def dbget_id(self, table, id):
-        return self.checker.checker.session.query(table).get(id)
+        return self.checker.checker.dbget_id(table, id)
 
     def dbget(self, table, identifier):
-        return self.checker.checker.session.query(table
-                ).filter_by(identifier=identifier).one()
+        return self.checker.checker.dbget(table, identifier)
+
+    def dball(self, table):
+        return self.checker.checker.dball(table)
 
 def normalize(normalizer):
     def wrapper(checker):
@@ -225,12 +345,7 @@ class ArticleChecker(object):
         try:
             return self._article
         except AttributeError:
-            try:
-                article = self.checker.cache[self.article_name]
-            except KeyError:
-                self._article = None
-            else:
-                self._article = wikiparse.wikiparse(article)
+            self._article = self.checker.articles.get(self.article_name)
             return self._article
 
     def find_template(self, name, section=None, *args, **kwargs):
@@ -256,34 +371,519 @@ class ArticleChecker(object):
                 yield error
         sys.stdout.write(' ' * len(msg) + '\r')
         sys.stdout.flush()
+        self.release()
+
+    def release(self):
+        """Forget the parsed article, when this checker is done
+
+        Call this even if the checker did not run, so the WikiChecker's
+        article registry knows when the tree is not needed any more.
+        """
+        self.__dict__.pop('_article', None)
+        self.checker.articles.release(self.article_name)
+
+class ArticleRegistry(object):
+    """Parsed articles of a run, shared by the checkers that need them
+
+    Each page is parsed once, and the tree is handed to every checker that
+    asks for it. Trees are keyed by title and revision; if the cache gets a
+    newer revision of a page, it's parsed again.
+
+    If the number of checkers of each page is announced with expect(), a
+    tree is dropped when the last of them releases it. Trees of pages
+    that weren't announced are dropped when `spare` newer ones are
+    released after them.
+
+    The titles of the template pages expanded in each page are kept after
+    the tree is dropped; see templates_of(). If the checkers that will ask
+    for them are announced too, they're dropped once the last of those
+    calls release_templates().
+
+    If `keep_trees` is true, trees are not dropped at all. When a newer
+    revision of a page is asked for, its sections that did not change are
+    then taken over from the old tree rather than parsed again. That's
+    for watch mode, where pages change over the run.
+    """
+    spare = 8
+    keep_trees = False
+
+    def __init__(self, wiki_checker):
+        self.wiki_checker = wiki_checker
+        self.reset()
+
+    def reset(self):
+        """Drop all trees and announced checkers"""
+        # title -> (revision, tree)
+        self.trees = {}
+        # title -> number of checkers that have yet to release the tree
+        self.consumers = collections.defaultdict(int)
+        # titles of released, unannounced trees, least recent first
+        self.spares = collections.OrderedDict()
+        # title -> titles of the template pages its expansions used
+        self.templates = {}
+        # title -> number of checkers that have yet to release its templates
+        self.template_consumers = collections.defaultdict(int)
+        self.num_parsed = 0
+
+    def expect(self, title, needed_titles=()):
+        """Announce a checker that will need the page
+
+        `needed_titles` are the pages whose templates_of() it will need.
+        """
+        self.consumers[title] += 1
+        for needed_title in needed_titles:
+            self.template_consumers[needed_title] += 1
+
+    def get(self, title):
+        """Return the parsed page, or None if it doesn't exist"""
+        cache = self.wiki_checker.cache
+        revision = cache.get_revision(title)
+        try:
+            tree_revision, previous = self.trees[title]
+        except KeyError:
+            previous = None
+        else:
+            if tree_revision == revision:
+                return previous
+        try:
+            text = cache[title]
+        except KeyError:
+            tree = None
+        else:
+            expander = self.wiki_checker.expander
+            profile = self.wiki_checker.profile
+            with expander.recording() as used:
+                if profile is None:
+                    tree = wikiparse.wikiparse(text, previous,
+                            expander=expander)
+                else:
+                    with profile.timed('parse', 'wikiparse'):
+                        tree = wikiparse.wikiparse(text, previous,
+                                expander=expander)
+            self.templates[title] = frozenset(used)
+            self.num_parsed += 1
+        self.trees[title] = revision, tree
+        return tree
+
+    def templates_of(self, titles):
+        """Return the titles of the templates expanded in the parsed pages"""
+        templates = set()
+        for title in titles:
+            templates.update(self.templates.get(title, ()))
+        return templates
+
+    def pages_using(self, template_titles):
+        """Return the titles of parsed pages that expanded template_titles
+
+        The template titles must be normalized.
+        """
+        normalize = self.wiki_checker.cache.normalize_title
+        template_titles = set(template_titles)
+        return [title for title, used in self.templates.items()
+                if any(normalize(template) in template_titles
+                    for template in used)]
+
+    def forget(self, titles):
+        """Parse the pages again when they're next asked for
+
+        The old trees are still used as `previous` trees, if kept.
+        """
+        for title in titles:
+            if title in self.trees:
+                revision, tree = self.trees[title]
+                self.trees[title] = None, tree
+
+    def release_templates(self, titles):
+        """Called by each checker when it's done with templates_of(titles)"""
+        for title in titles:
+            if self.template_consumers.get(title):
+                self.template_consumers[title] -= 1
+                if not self.template_consumers[title]:
+                    del self.template_consumers[title]
+                    if not self.keep_trees:
+                        self.templates.pop(title, None)
+
+    def release(self, title):
+        """Called by each checker of the page when it's done"""
+        if self.keep_trees:
+            self.consumers.pop(title, None)
+        elif self.consumers.get(title):
+            self.consumers[title] -= 1
+            if not self.consumers[title]:
+                del self.consumers[title]
+                self.trees.pop(title, None)
+        elif title in self.trees:
+            self.spares.pop(title, None)
+            self.spares[title] = None
+            while len(self.spares) > self.spare:
+                old_title, unused = self.spares.popitem(last=False)
+                self.trees.pop(old_title, None)
+
+class Selection(object):
+    """Which checkers to run; by default, all of them
+
+    :param species: List of (first, last) ranges of species IDs
+    :param moves: Identifiers of moves
+    :param checker_names: Names of checker classes, or their `name`s
+    :param changed_since: MediaWiki timestamp; only checkers that need an
+        article changed since then are run
+    :param shard: (index, count): only checkers whose article is in the
+        index-th of `count` shards are run; see shard_of. Index counts from 1.
+
+    If species are selected but moves are not, no move checkers are run,
+    and vice versa.
+    WikiChecker.checkers() should filter its queries through species()
+    and moves(); the rest is done by the WikiChecker.
+    """
+    changed_titles = None
+
+    def __init__(self, species=None, moves=None, checker_names=None,
+            changed_since=None, shard=None):
+        self.species_ranges = species
+        self.move_identifiers = moves
+        self.checker_names = checker_names
+        self.changed_since = changed_since
+        self.shard = shard
+
+    @property
+    def everything(self):
+        return self.shard is None and self.unfiltered
+
+    @property
+    def unfiltered(self):
+        """True if nothing but the shard limits the selection"""
+        return (self.species_ranges is None and self.move_identifiers is None
+                and self.checker_names is None and self.changed_since is None)
+
+    def species(self, query):
+        """Filter a query of PokemonSpecies"""
+        from sqlalchemy import or_
+        from pokedex.db import tables
+        if self.species_ranges is None:
+            if self.move_identifiers is None:
+                return query
+            else:
+                return []
+        return query.filter(or_(*[
+                tables.PokemonSpecies.id.between(first, last)
+                for first, last in self.species_ranges]))
+
+    def moves(self, query):
+        """Filter a query of Move"""
+        from pokedex.db import tables
+        if self.move_identifiers is None:
+            if self.species_ranges is None:
+                return query
+            else:
+                return []
+        return query.filter(tables.Move.identifier.in_(self.move_identifiers))
+
+    def resolve(self, cache):
+        """Look up the articles changed since `changed_since`"""
+        if self.changed_since is not None and self.changed_titles is None:
+            self.changed_titles = set(cache.normalize_title(title) for title
+                    in cache.changed_titles(self.changed_since))
+
+    def wants(self, checker, cache):
+        """True if the checker is selected"""
+        if self.shard is not None:
+            index, count = self.shard
+            if shard_of(checker.article_name, count) != index:
+                return False
+        if self.checker_names is not None:
+            if (type(checker).__name__ not in self.checker_names and
+                    getattr(checker, 'name', None) not in self.checker_names):
+                return False
+        if self.changed_titles is not None:
+            return any(cache.normalize_title(title) in self.changed_titles
+                    for title in getattr(checker, 'needed_articles', []))
+        return True
+
+    @classmethod
+    def parse_species(cls, string):
+        """Parse ranges of species IDs, like '1-151,251'"""
+        ranges = []
+        for part in string.split(','):
+            first, sep, last = part.partition('-')
+            ranges.append((int(first), int(last or first)))
+        return ranges
+
+    @classmethod
+    def parse_shard(cls, string):
+        """Parse a shard, like '2/5'"""
+        index, sep, count = string.partition('/')
+        index, count = int(index), int(count)
+        if not 1 <= index <= count:
+            raise ValueError(string)
+        return index, count
+
+def shard_of(title, count):
+    """Return the shard (counting from 1) an article belongs to
+
+    The same on all machines, unlike hash().
+    """
+    digest = hashlib.md5(title.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count + 1
 
 class WikiChecker(object):
     base_url = 'http://bulbapedia.bulbagarden.net/w/api.php?'
+    profile = None
+    selection = Selection()
+
+    @property
+    def articles(self):
+        """The ArticleRegistry of this checker"""
+        try:
+            return self._articles
+        except AttributeError:
+            self._articles = ArticleRegistry(self)
+            return self._articles
 
     def __init__(self):
         self.cache = WikiCache(self.base_url)
+        self.expander = wikiparse.Expander(self.cache)
 
-    def check(self):
-        errors = []
-        checkers = []
-
-        for checker, i in zip(self.checkers(), xrange(9999999)):
-            needs_articles = False
-            needed_articles = getattr(checker, 'needed_articles', [])
-            self.cache.mark_needed_pages(needed_articles)
-            for article in needed_articles:
-                if not self.cache.is_up_to_date(article):
-                    needs_articles = True
-            checkers.append((checker, i))
-        self.cache.fetch_pages()
-        for checker, number in checkers:
-            new_errors = list(checker())
+    def prefetch(self, titles):
+        """Bring pages and the templates they may expand up to date"""
+        titles = set(titles)
+        self.cache.prefetch_pages(titles)
+        self.expander.prefetch(titles)
+
+    def reopen(self):
+        """Connect to the databases anew, in a worker process
+
+        The wiki cache becomes read-only. Subclasses with a pokedex session
+        should extend this to connect() a new one.
+        """
+        self.cache.reopen(read_only=True)
+        self.__dict__.pop('_reference_cache', None)
+
+    # Names of small pokedex tables that don't change during a run.
+    # dbget, dbget_id and dball load each of them whole, once.
+    reference_tables = ['Language', 'Version', 'VersionGroup', 'Generation',
+            'Pokedex', 'Stat']
+
+    def _reference_data(self, table):
+        """Return ({id: row}, {identifier: row}, rows) of a reference table
+
+        Or None if the table isn't one. The rows are the session's own
+        objects, and stay in its identity map while they're kept here.
+        """
+        if table.__name__ not in self.reference_tables:
+            return None
+        try:
+            reference_cache = self._reference_cache
+        except AttributeError:
+            reference_cache = self._reference_cache = {}
+        try:
+            return reference_cache[table]
+        except KeyError:
+            pass
+        rows = self.session.query(table).order_by(table.id).all()
+        data = reference_cache[table] = (
+                dict((row.id, row) for row in rows),
+                dict((row.identifier, row) for row in rows),
+                rows)
+        return data
+
+    def dbget_id(self, table, id):
+        """Return the row of `table` with the ID, or None"""
+        data = self._reference_data(table)
+        if data is None:
+            return self.session.query(table).get(id)
+        return data[0].get(id)
+
+    def dbget(self, table, identifier):
+        """Return the row of `table` with the identifier
+
+        Raises NoResultFound if there's none.
+        """
+        data = self._reference_data(table)
+        if data is None:
+            return self.session.query(table).filter_by(
+                    identifier=identifier).one()
+        try:
+            return data[1][identifier]
+        except KeyError:
+            from sqlalchemy.orm.exc import NoResultFound
+            raise NoResultFound('No %s %r' % (table.__name__, identifier))
+
+    def dball(self, table):
+        """Return all rows of `table`, in ID order"""
+        data = self._reference_data(table)
+        if data is None:
+            return self.session.query(table).order_by(table.id).all()
+        return list(data[2])
+
+    def selected_checkers(self):
+        """Generate (number, checker) for the checkers of self.selection
+
+        The number is the checker's position among all checkers, so errors
+        sort the same way whatever the selection.
+        """
+        for number, checker in enumerate(self.checkers()):
+            if self.selection.wants(checker, self.cache):
+                yield number, checker
+
+    def check(self, processes=1, incremental=True, profile_path=None,
+            streaming=False, selection=None):
+        """Run all the checkers, and write the mismatches file
+
+        If `processes` is not 1, the checkers are run in that many worker
+        processes (None means one per CPU); see _check_parallel.
+
+        Each checker's errors are saved along with a key made of the
+        revisions of its articles and of the templates expanded in them, the
+        pokedex fingerprint and the version of the checker code; see
+        result_key. If `incremental` is true,
+        checkers whose key didn't change since the last run are not run
+        again; their saved errors are used instead.
+
+        If `profile_path` is given, checkers that are run are timed; a report
+        is printed, and the timings are saved there as JSON. See Profile.
+
+        If `streaming` is true, memory use does not grow with the number of
+        checkers: checkers are made twice (first to find out which pages
+        are needed, then to run them) rather than kept, and errors are
+        sorted on disk.
+
+        If a `selection` is given, only the checkers it selects are made, and
+        only their articles are fetched. Saved results of other checkers are
+        kept, and the report is written to mismatches-subset rather than
+        mismatches. See Selection.
+        If the selection is a shard, its sorted errors are saved to a partial
+        file instead of a report; merge_shards() makes a report from those.
+        """
+        if profile_path:
+            self.profile = Profile()
+        if selection is not None:
+            self.selection = selection
+        self.selection.resolve(self.cache)
+
+        # Plan: collect the pages all checkers need, then fetch them at once
+        self.articles.reset()
+        needed_titles = set()
+        kept_checkers = []
+        for number, checker in self.selected_checkers():
+            needed_titles.update(getattr(checker, 'needed_articles', []))
+            self.articles.expect(checker.article_name,
+                    getattr(checker, 'needed_articles', []))
+            if not streaming:
+                kept_checkers.append((number, checker))
+        self.prefetch(needed_titles)
+        del needed_titles
+        if streaming:
+            checkers = self.selected_checkers()
+        else:
+            checkers = kept_checkers
+            del kept_checkers
+
+        store = _ResultStore(self._results_path,
+                self.expander.template_revision)
+        sorter = _ErrorSorter(self.spill_limit if streaming else None)
+        if processes == 1:
+            results = self._check_serial(checkers, store, incremental)
+        else:
+            results = self._check_parallel(checkers, store, incremental,
+                    processes)
+        for number, checker_id, key, new_errors in results:
             for error in new_errors:
                 error.checker_number = number
                 print error.str_format()
-            errors.extend(new_errors)
-        print '%s mismatches found' % len(errors)
+                sorter.add(error)
+            store.save(checker_id, key, new_errors)
+        store.close(prune=self.selection.everything)
+        print '%s mismatches found (%s checkers run, %s unchanged)' % (
+                len(sorter), store.num_run, store.num_replayed)
+        if processes == 1:
+            print '%s articles parsed' % self.articles.num_parsed
+        if self.profile is not None:
+            self.profile.report()
+            self.profile.save(profile_path)
+        if self.selection.shard is None:
+            self.write_report(sorter)
+        else:
+            self.write_shard(sorter)
+        sorter.close()
+
+    def write_shard(self, sorter):
+        """Save the errors of a shard run, for merge_shards()"""
+        index, count = self.selection.shard
+        shard_path = os.path.join(self.path,
+                'mismatches-shard-%s-of-%s' % (index, count))
+        with open(shard_path, 'wb') as shard_file:
+            header = dict(shard=self.selection.shard, count=len(sorter),
+                    unfiltered=self.selection.unfiltered,
+                    sync_timestamp=self.cache.wiki.sync_timestamp)
+            pickle.dump(header, shard_file, pickle.HIGHEST_PROTOCOL)
+            for record in sorter.sorted_records():
+                pickle.dump(record, shard_file, pickle.HIGHEST_PROTOCOL)
+        print '%s mismatches saved to %s' % (len(sorter), shard_path)
+
+    def merge_shards(self, paths):
+        """Write the report from the files saved by shard runs
+
+        The report is the same as that of a single run. It is written to
+        mismatches-subset if some shards are missing, or if the shard runs
+        selected only some checkers.
+        Giving the same file, or the same shard, twice is an error.
+        """
+        real_paths = set()
+        for path in paths:
+            if os.path.realpath(path) in real_paths:
+                raise ValueError('Shard file given more than once: %s' % path)
+            real_paths.add(os.path.realpath(path))
+        sorter = _ErrorSorter()
+        shards = set()
+        unfiltered = True
+        sync_timestamps = []
+        for path in paths:
+            shard_file = open(path, 'rb')
+            header = pickle.load(shard_file)
+            if header['shard'] in shards:
+                raise ValueError('Shard %s/%s given more than once' %
+                        header['shard'])
+            sorter.add_run(shard_file, header['count'])
+            shards.add(header['shard'])
+            unfiltered = unfiltered and header['unfiltered']
+            if header['sync_timestamp'] is not None:
+                sync_timestamps.append(header['sync_timestamp'])
+        counts = set(count for index, count in shards)
+        if len(counts) != 1:
+            raise ValueError('Shards of different runs: %s' % sorted(shards))
+        count, = counts
+        missing = set(range(1, count + 1)) - set(
+                index for index, count in shards)
+        if missing:
+            print 'Missing shards: %s' % ', '.join(
+                    '%s/%s' % (index, count) for index in sorted(missing))
+        if unfiltered and not missing:
+            report_name = 'mismatches'
+        else:
+            report_name = 'mismatches-subset'
+        # The report is as old as the oldest shard
+        self.write_report(sorter, report_name,
+                min(sync_timestamps) if sync_timestamps else None)
+        sorter.close()
+
+    @property
+    def report_name(self):
+        """File name of the report, in self.path"""
+        if self.selection.everything:
+            return 'mismatches'
+        else:
+            return 'mismatches-subset'
+
+    def write_report(self, sorter, report_name=None, sync_timestamp=None):
+        """Write the report of the errors in an _ErrorSorter
 
+        Errors listed in the `expected` file are left out.
+        The report name and wiki revision default to those of this run.
+        """
+        if report_name is None:
+            report_name = self.report_name
+        if sync_timestamp is None:
+            sync_timestamp = self.cache.wiki.sync_timestamp
         try:
             expected_file = open(os.path.join(self.path, 'expected'))
         except IOError:
@@ -292,7 +892,7 @@ class WikiChecker(object):
             expected = set(s.decode('utf-8').strip() for s in
                     expected_file.readlines())
 
-        with open(os.path.join(self.path, 'mismatches'), 'w') as error_file:
+        with open(os.path.join(self.path, report_name), 'w') as error_file:
             base_url, sep, b = self.base_url.rpartition('api.php?')
             if b:
                 base_url = self.base_url
@@ -310,26 +910,518 @@ class WikiChecker(object):
             It's up to humans to decide which is which.
             }}
 
-            ''' % (base_url, self.cache.wiki.sync_timestamp)))
-            ignored = []
-            for error in sorted(errors, key=lambda e: (e.sort_key, e.checker_number, e.args)):
-                str_formatted = error.str_format()
+            ''' % (base_url, sync_timestamp)))
+            num_ignored = 0
+            for str_formatted in sorter:
                 if str_formatted.replace('\n', r'\n') in expected:
-                    ignored.append(str_formatted)
+                    num_ignored += 1
                 else:
                     error_file.write('* ')
                     error_file.write(str_formatted.encode('utf-8'))
                     error_file.write('\n')
             error_file.write('\n')
             error_file.write('{{User:En-Cu-Kou/T|total||| num = %s }}\n' %
-                    (len(errors) - len(ignored)))
-            if ignored:
+                    (len(sorter) - num_ignored))
+            if num_ignored:
                 error_file.write('{{User:En-Cu-Kou/T|ignored||| num = %s }}\n' %
-                        len(ignored))
+                        num_ignored)
+
+        print '%s mismatches written to %s' % (len(sorter) - num_ignored,
+                report_name)
+        print '%s expected mismatches ignored' % num_ignored
+
+    # Errors kept in memory at most, when streaming
+    spill_limit = 10000
+
+    def watch(self, interval=60, selection=None):
+        """Recheck articles as they change on the wiki, until interrupted
+
+        All checkers are run first, as in an incremental check(). Then every
+        `interval` seconds, WikiCache.update fetches the recent changes;
+        checkers that need a changed article are run again, and the report
+        is rewritten from the errors kept in memory.
+        Parsed articles are kept as well, so only the sections that changed
+        are parsed again; see ArticleRegistry.keep_trees.
+        A change to a template counts as a change to the articles that
+        expanded it. Each round uses a new Expander, so that expansions
+        memoized before the change are not used.
+        """
+        if selection is not None:
+            self.selection = selection
+        self.selection.resolve(self.cache)
+        checkers = list(self.selected_checkers())
+        # normalized title -> positions in `checkers` of those that need it
+        positions_by_title = collections.defaultdict(list)
+        self.articles.reset()
+        self.articles.keep_trees = True
+        for position, (number, checker) in enumerate(checkers):
+            for title in getattr(checker, 'needed_articles', []):
+                positions_by_title[self.cache.normalize_title(title)].append(
+                        position)
+            self.articles.expect(checker.article_name)
+        errors = [None] * len(checkers)
+        changed_positions = range(len(checkers))
+        while True:
+            self.prefetch(title
+                    for position in changed_positions
+                    for title in getattr(checkers[position][1],
+                            'needed_articles', []))
+            store = _ResultStore(self._results_path,
+                    self.expander.template_revision)
+            results = self._check_serial(
+                    [checkers[position] for position in changed_positions],
+                    store, incremental=True)
+            for position, (number, checker_id, key, new_errors) in (
+                    itertools.izip(changed_positions, results)):
+                for error in new_errors:
+                    error.checker_number = number
+                    print error.str_format()
+                store.save(checker_id, key, new_errors)
+                errors[position] = new_errors
+            store.close(prune=False)
+            print '%s checkers rechecked (%s run, %s unchanged)' % (
+                    len(changed_positions), store.num_run, store.num_replayed)
+            sorter = _ErrorSorter()
+            for checker_errors in errors:
+                for error in checker_errors:
+                    sorter.add(error)
+            self.write_report(sorter)
+            sorter.close()
+
+            changed_positions = []
+            while not changed_positions:
+                time.sleep(interval)
+                changed_titles = self.cache.update()
+                if changed_titles is None:
+                    # The whole cache was invalidated
+                    self.articles.forget(list(self.articles.trees))
+                    changed_positions = range(len(checkers))
+                else:
+                    changed_titles = set(self.cache.normalize_title(title)
+                            for title in changed_titles)
+                    using = self.articles.pages_using(changed_titles)
+                    self.articles.forget(using)
+                    changed_titles.update(self.cache.normalize_title(title)
+                            for title in using)
+                    changed_positions = sorted(set(position
+                        for title in changed_titles
+                        for position in positions_by_title.get(title, ())))
+            self.expander = wikiparse.Expander(self.cache)
+
+    def _check_serial(self, checkers, store, incremental):
+        """Run checkers; generate (number, checker id, result key, errors)
+
+        `checkers` gives (number, checker) pairs, as selected_checkers does.
+        """
+        for number, checker in checkers:
+            checker_id = _checker_id(checker)
+            key = self.result_key(checker)
+            replayed = store.replay(checker_id, key) if incremental else None
+            if replayed is None:
+                errors = self._run_checker(checker)
+                key += (self.template_revisions(checker), )
+            else:
+                key, errors = replayed
+                checker.release()
+                self.articles.release_templates(
+                        getattr(checker, 'needed_articles', []))
+            yield number, checker_id, key, errors
+
+    def result_key(self, checker):
+        """Key that changes whenever the checker's result might change
+
+        It's made of the revisions of the checker's articles, the pokedex
+        fingerprint, and the version of the checker's code.
+        Results are saved with the template_revisions() added to the key;
+        see _ResultStore.
+        """
+        revisions = tuple((title, self.cache.get_revision(title))
+                for title in getattr(checker, 'needed_articles', []))
+        return code_version(type(checker)), self.db_fingerprint(), revisions
+
+    def template_revisions(self, checker):
+        """Revisions of the templates expanded in a checker's articles
+
+        Call this once, after the checker ran. See Expander.template_revision.
+        """
+        needed_titles = getattr(checker, 'needed_articles', [])
+        titles = self.articles.templates_of(needed_titles)
+        self.articles.release_templates(needed_titles)
+        return tuple((title, self.expander.template_revision(title))
+                for title in sorted(titles))
+
+    def db_fingerprint(self):
+        """Fingerprint of the contents of the pokedex database, or None
+
+        It's cheap, and computed once per run; the result keys and the facts
+        cache share it. For a SQLite file it's made from the file's size and
+        modification time. For other databases it's made from the row count
+        and largest primary key of each table, so edits that don't add or
+        remove rows go unnoticed there: run with --full after those.
+        """
+        try:
+            return self._db_fingerprint
+        except AttributeError:
+            pass
+        session = getattr(self, 'session', None)
+        if session is None:
+            self._db_fingerprint = None
+            return None
+        digest = hashlib.sha1()
+        url = session.get_bind().url
+        if url.drivername.startswith('sqlite') and url.database and (
+                os.path.isfile(url.database)):
+            info = os.stat(url.database)
+            digest.update(repr((info.st_size, info.st_mtime)))
+        else:
+            from sqlalchemy import func, select
+            from pokedex.db import tables
+            for table in tables.metadata.sorted_tables:
+                columns = [func.count()] + [func.max(column)
+                        for column in table.primary_key.columns]
+                row = session.execute(select(columns).select_from(table)
+                        ).fetchone()
+                digest.update(table.name.encode('utf-8'))
+                digest.update(repr(tuple(row)))
+        self._db_fingerprint = digest.hexdigest()
+        return self._db_fingerprint
+
+    # Cache of preload.ExpectedFacts; shared by the wikis, so not in self.path
+    facts_path = os.path.join('data', 'facts.pickle')
 
-        print '%s mismatches written to file' % (len(errors) - len(ignored))
-        print '%s expected mismatches ignored' % len(ignored)
+    @property
+    def facts(self):
+        """The preload.ExpectedFacts of the pokedex of this run"""
+        try:
+            return self._facts
+        except AttributeError:
+            from pokemwdb import preload
+            key = self.db_fingerprint()
+            if key is not None:
+                key = key, source_version([preload.__name__])
+            self._facts = preload.ExpectedFacts.load(self.session, key,
+                    self.facts_path)
+            return self._facts
+
+    @property
+    def _results_path(self):
+        return os.path.join(self.path, 'results.sqlite')
+
+    def _run_checker(self, checker):
+        """Run a checker and return its errors, timing it if profiling"""
+        if self.profile is None:
+            return list(checker())
+        start = timeit.default_timer()
+        errors = list(checker())
+        seconds = timeit.default_timer() - start
+        self.profile.add('checker', type(checker).__name__, seconds)
+        self.profile.add('article', '%s (%s)' % (checker.article_name,
+                checker.name), seconds)
+        return errors
+
+    def _check_parallel(self, checkers, store, incremental, processes,
+            chunksize=4):
+        """Run checkers in worker processes, like _check_serial
+
+        Results come in the order of `checkers`, so the output is the same
+        as for a serial run.
+        Workers are forked from this process. Each reopen()s its databases
+        and makes its own checkers, which must come in the same order as
+        here. The cache is read-only in workers; pages and templates are
+        prefetched here, and expansions only use templates that are up to
+        date in the cache, so workers see the same pages as a serial run.
+        """
+        global _worker_checker
+        # (number, checker id, key, whether to replay); small enough to keep
+        plan = []
+        tasks = []
+        for number, checker in checkers:
+            checker_id = _checker_id(checker)
+            key = self.result_key(checker)
+            replay = incremental and store.has(checker_id, key)
+            plan.append((number, checker_id, key, replay))
+            if not replay:
+                tasks.append((number, checker.article_name))
+        _worker_checker = self
+        pool = multiprocessing.Pool(processes, _init_worker)
+        try:
+            new_results = pool.imap(_run_worker_checker, tasks, chunksize)
+            for number, checker_id, key, replay in plan:
+                if replay:
+                    key, errors = store.replay(checker_id, key)
+                else:
+                    (result_number, errors, template_revisions,
+                            timings) = next(new_results)
+                    assert result_number == number
+                    key += (template_revisions, )
+                    if timings:
+                        self.profile.update(timings)
+                yield number, checker_id, key, errors
+        finally:
+            _worker_checker = None
+            pool.terminate()
+            pool.join()
 
     def error(self, message):
         self.errors.append(message)
         print message
+
+class _ResultStore(object):
+    """Saved results of checkers, in a SQLite file
+
+    For each checker there's the result key and the errors. The key is
+    that of WikiChecker.result_key, plus the (title, revision) of the
+    templates expanded; a result is replayed if the first part is the same,
+    and `template_revision` gives the same revision for each template.
+    Results of checkers that are not saved again in a run are removed when
+    the store is closed, unless only some checkers ran.
+    """
+    def __init__(self, path, template_revision):
+        self.template_revision = template_revision
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                checker TEXT PRIMARY KEY, key BLOB, errors BLOB, seen INTEGER)''')
+        self.connection.execute('UPDATE results SET seen = 0')
+        self.num_run = self.num_replayed = 0
+
+    def _load(self, checker_id, key):
+        row = self.connection.execute(
+                'SELECT key, errors FROM results WHERE checker = ?',
+                (repr(checker_id), )).fetchone()
+        if row is None:
+            return None
+        try:
+            saved_key = pickle.loads(str(row[0]))
+            if saved_key[:-1] == key and all(
+                    self.template_revision(title) == revision
+                    for title, revision in saved_key[-1]):
+                return saved_key, str(row[1])
+        except Exception:
+            # E.g. an error class was renamed; the result is stale anyway
+            pass
+        return None
+
+    def has(self, checker_id, key):
+        """True if there are saved errors for the checker and key"""
+        return self._load(checker_id, key) is not None
+
+    def replay(self, checker_id, key):
+        """Return (saved key, errors) if the key matches, otherwise None"""
+        loaded = self._load(checker_id, key)
+        if loaded is None:
+            return None
+        saved_key, errors = loaded
+        self.num_replayed += 1
+        return saved_key, pickle.loads(errors)
+
+    def save(self, checker_id, key, errors):
+        self.connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, 1)',
+                (repr(checker_id),
+                    sqlite3.Binary(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)),
+                    sqlite3.Binary(pickle.dumps(errors, pickle.HIGHEST_PROTOCOL))))
+
+    def close(self, prune=True):
+        self.num_run = self.connection.execute(
+                'SELECT count(*) FROM results WHERE seen = 1'
+                ).fetchone()[0] - self.num_replayed
+        if prune:
+            self.connection.execute('DELETE FROM results WHERE seen = 0')
+        self.connection.commit()
+        self.connection.close()
+
+class _ErrorSorter(object):
+    """Sorts errors for the report; iterating gives their str_format()
+
+    The order is that of (sort_key, checker_number, args), then the order
+    they were added in.
+    If `limit` is given, no more than that many errors are kept in memory;
+    the rest are written to temporary files in sorted runs, which are
+    merged when iterating.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.records = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, error):
+        self.records.append(((error.sort_key, error.checker_number,
+                error.args), self.count, error.str_format()))
+        self.count += 1
+        if self.limit is not None and len(self.records) >= self.limit:
+            self._spill()
+
+    def _spill(self):
+        self.records.sort()
+        run = tempfile.TemporaryFile()
+        for record in self.records:
+            pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+        self.runs.append((run, 0))
+        self.records = []
+
+    def add_run(self, run, count):
+        """Add `count` sorted records, pickled in a file after its position
+        """
+        self.runs.append((run, run.tell()))
+        self.count += count
+
+    def _read_run(self, run, offset):
+        run.seek(offset)
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __len__(self):
+        return self.count
+
+    def sorted_records(self):
+        self.records.sort()
+        streams = [self._read_run(run, offset) for run, offset in self.runs]
+        streams.append(iter(self.records))
+        return heapq.merge(*streams)
+
+    def __iter__(self):
+        for key, count, str_formatted in self.sorted_records():
+            yield str_formatted
+
+    def close(self):
+        for run, offset in self.runs:
+            run.close()
+        self.runs = []
+        self.records = []
+
+def _checker_id(checker):
+    cls = type(checker)
+    return cls.__module__, cls.__name__, checker.article_name
+
+_code_versions = {}
+
+# Modules that compute expected values for checkers, besides their own
+checker_support_modules = ['pokemwdb.preload', 'pokemwdb.changelog']
+
+def code_version(cls):
+    """Hash of the source of the modules a checker class depends on
+
+    These are the modules of the class and its bases, this module,
+    wikiparse, and the checker_support_modules.
+    """
+    try:
+        return _code_versions[cls]
+    except KeyError:
+        pass
+    module_names = set(base.__module__ for base in inspect.getmro(cls))
+    module_names.update([__name__, wikiparse.__name__])
+    module_names.update(checker_support_modules)
+    version = _code_versions[cls] = source_version(module_names)
+    return version
+
+def source_version(module_names):
+    """Hash of the source of the named modules
+
+    Modules that aren't loaded, or have no source, are left out.
+    """
+    digest = hashlib.sha1()
+    for module_name in sorted(module_names):
+        try:
+            source_path = inspect.getsourcefile(sys.modules[module_name])
+        except (KeyError, TypeError):
+            # Not loaded, or built-in
+            continue
+        with open(source_path, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+# State of worker processes for WikiChecker._check_parallel
+_worker_checker = None
+_worker_checkers = None
+
+def _init_worker():
+    global _worker_checkers
+    _worker_checker.reopen()
+    # Workers get checkers in no particular order
+    _worker_checker.articles.reset()
+    _worker_checkers = dict(_worker_checker.selected_checkers())
+
+def _run_worker_checker(task):
+    number, article_name = task
+    checker = _worker_checkers.pop(number)
+    assert checker.article_name == article_name, (
+            'Checkers must come in the same order in each process')
+    wiki_checker = checker.checker
+    if wiki_checker.profile is None:
+        errors = list(checker())
+        timings = None
+    else:
+        # Hand back the timings of this checker only
+        wiki_checker.profile = Profile()
+        errors = wiki_checker._run_checker(checker)
+        timings = dict(wiki_checker.profile.timings)
+    return (number, errors, wiki_checker.template_revisions(checker),
+            timings)
+
+def main(checker_class, argv=None):
+    """Run a WikiChecker subclass from the command line"""
+    parser = argparse.ArgumentParser(
+            description='Check %s against the pokedex' % checker_class.base_url)
+    parser.add_argument('-j', '--processes', type=int, default=1,
+            help='number of worker processes to run checkers in; '
+                '0 means one per CPU (default: 1, no workers)')
+    parser.add_argument('--full', action='store_true',
+            help='run all checkers, even those whose articles, database '
+                'and code did not change since the last run')
+    parser.add_argument('--profile', metavar='FILE',
+            help='time the checkers, articles and template parameters; '
+                'print a report and save the timings to FILE as JSON')
+    parser.add_argument('--streaming', action='store_true',
+            help='keep memory use flat, by making the checkers twice and '
+                'sorting errors on disk')
+    parser.add_argument('--watch', metavar='SECONDS', type=int,
+            help='keep running, and recheck articles that changed on the '
+                'wiki every SECONDS; checkers are run in this process')
+    group = parser.add_argument_group('selection',
+            'Run only some checkers. Results of the others are kept, and the '
+            'report is written to mismatches-subset.')
+    group.add_argument('--species', metavar='IDS', action='append',
+            type=Selection.parse_species,
+            help='check species with these IDs, e.g. 1-151,251')
+    group.add_argument('--move', metavar='IDENTIFIER', action='append',
+            dest='moves', help='check the move with this identifier')
+    group.add_argument('--checker', metavar='NAME', action='append',
+            dest='checker_names',
+            help='run checkers with this class name or name, e.g. infobox')
+    group.add_argument('--changed-since', metavar='TIMESTAMP',
+            help='run checkers whose articles changed on the wiki since '
+                'this time, e.g. 2012-06-01T00:00:00Z')
+    group.add_argument('--shard', metavar='I/N', type=Selection.parse_shard,
+            help='run the I-th of N parts of the checkers, split by article; '
+                'save the errors for --merge instead of writing a report')
+    parser.add_argument('--merge', metavar='FILE', nargs='+',
+            help='write the report from the files saved by --shard runs')
+    args = parser.parse_args(argv)
+    if args.merge:
+        checker_class().merge_shards(args.merge)
+        return
+    if args.species is not None:
+        args.species = sum(args.species, [])
+    selection = Selection(species=args.species, moves=args.moves,
+            checker_names=args.checker_names,
+            changed_since=args.changed_since, shard=args.shard)
+    if args.watch:
+        ignored = [option for option, used in [
+                ('-j', args.processes != 1),
+                ('--full', args.full),
+                ('--profile', args.profile),
+                ('--streaming', args.streaming),
+            ] if used]
+        if ignored:
+            parser.error('%s cannot be used with --watch' %
+                    ', '.join(ignored))
+        checker_class().watch(args.watch, selection=selection)
+    else:
+        checker_class().check(processes=args.processes or None,
+                incremental=not args.full, profile_path=args.profile,
+                streaming=args.streaming, selection=selection)
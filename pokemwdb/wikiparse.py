@@ -4,7 +4,15 @@ from __future__ import unicode_literals
 
 import re
 import textwrap
+import warnings
 import collections
+import contextlib
+import functools
+import multiprocessing
+import cPickle as pickle
+import gc
+import bisect
+import math
 
 from pokemwdb.wikicache import WikiCache
 
@@ -22,68 +30,308 @@ def make_wikiname(string):
     string = string[0].upper() + string[1:]
     return string
 
+def normalize_header(string):
+    return ' '.join(unicode(string).split())
+
 ### Visitors
 
 class Visitor(object):
+    """Walks a tree depth-first, calling visit_<NodeType> for each node
+
+    Handlers are looked up once per visitor class and node type; visit_any
+    is only called if it is overridden.
+    """
+    breadth_first = False
+
     def visit(self, node):
-        self.dispatch(node)
-        node.visit(self.visit)
+        self._stopped = False
+        visit_any = self.visit_any
+        if visit_any.__func__ is Visitor.visit_any.__func__:
+            visit_any = None
+        handler = self._handler
+        nodes = collections.deque([node])
+        while nodes and not self._stopped:
+            if self.breadth_first:
+                node = nodes.popleft()
+            else:
+                node = nodes.pop()
+            if visit_any is not None:
+                visit_any(node)
+            func = handler(type(node))
+            if func is not None:
+                func(node)
+            if self.breadth_first:
+                nodes.extend(node._visited_children())
+            else:
+                nodes.extend(reversed(node._visited_children()))
+
+    def stop(self):
+        """Do not visit any more nodes"""
+        self._stopped = True
 
     def dispatch(self, node):
         self.visit_any(node)
+        func = self._handler(type(node))
+        if func is not None:
+            func(node)
+
+    def _handler(self, node_type):
+        """Return the bound handler for nodes of node_type, or None"""
         try:
-            func = getattr(self, 'visit_' + type(node).__name__)
+            return self._handlers[node_type]
         except AttributeError:
+            self._handlers = {}
+        except KeyError:
             pass
+        cls = type(self)
+        names = cls.__dict__.get('_handler_names')
+        if names is None:
+            names = cls._handler_names = {}
+        try:
+            name = names[node_type]
+        except KeyError:
+            name = 'visit_' + node_type.__name__
+            if not hasattr(cls, name):
+                name = None
+            names[node_type] = name
+        if name is None:
+            func = None
         else:
-            func(node)
+            func = getattr(self, name)
+        self._handlers[node_type] = func
+        return func
 
     def visit_any(self, node):
         pass
 
 class BreadthFirstVisitor(Visitor):
-    def visit(self, node):
-        nodes_left = collections.deque([node])
-        while nodes_left:
-            node = nodes_left.popleft()
-            self.dispatch(node)
-            node.visit(nodes_left.append)
+    breadth_first = True
 
 def find(node, type=None, predicate=lambda node: True, find_all=False):
-    class Find(BreadthFirstVisitor):
-        def __init__(self):
-            if type:
-                self.predicate = lambda node: (isinstance(node, type) and
-                        predicate(node))
-            else:
-                self.predicate = predicate
-            self.results = []
+    """Find nodes of the given type that match predicate, breadth-first
 
-        def visit_any(self, node):
-            if self.predicate(node):
-                self.results.append(node)
-                if not find_all:
-                    self.visit = lambda node: None
-
-    find = Find()
-    find.visit(node)
+    Returns the first matching node (or None), or a list of all matches if
+    find_all is true.
+    """
+    results = []
+    nodes = collections.deque([node])
+    while nodes:
+        node = nodes.popleft()
+        if (type is None or isinstance(node, type)) and predicate(node):
+            if not find_all:
+                return node
+            results.append(node)
+        nodes.extend(node._visited_children())
     if find_all:
-        return find.results
+        return results
     else:
-        try:
-            return find.results[0]
-        except IndexError:
-            return None
+        return None
+
+def find_section(node, *names):
+    """Find a section by the headers leading to it
+
+    For example, find_section(tree, 'Learnset', 'By leveling up').
+    Returns None if there's no such section.
+    """
+    path = tuple(normalize_header(name) for name in names)
+    return node.section_index.get(path)
 
 ### Nodes
 
-class Content(list):
+def memoized(func):
+    """Cache the result of a node method until the node is mutated
+
+    The method must take no arguments besides self.
+    """
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(self):
+        memo = self.__dict__.setdefault('_memo', {})
+        try:
+            return memo[name]
+        except KeyError:
+            result = memo[name] = func(self)
+            return result
+    return wrapper
+
+class Node(object):
+    """Base for parse tree nodes
+
+    Derived values (serialized text, normalized names, lookup tables) are
+    memoized on the nodes. Mutating a node discards the memos of that node
+    and of all its ancestors.
+
+    Parsed nodes know their span in the source: the text is
+    ``source[node.start:node.end]``. Once a node is mutated, its text no
+    longer comes from the source; the offsets are kept for error reporting.
+    """
+    _parent = None
+    _source = None
+    start = end = None
+
+    def _adopt(self, child):
+        if isinstance(child, Node):
+            child._parent = self
+        return child
+
+    def _set_span(self, source, start, end):
+        self.__dict__.update(_source=source, start=start, end=end)
+        return self
+
+    def invalidate(self):
+        node = self
+        while node is not None:
+            node.__dict__.pop('_memo', None)
+            node.__dict__.pop('_source', None)
+            node = node._parent
+
+    def _forget_memos(self):
+        """Discard memos of this node and its ancestors, but keep the spans"""
+        node = self
+        while node is not None:
+            node.__dict__.pop('_memo', None)
+            node = node._parent
+
+    @property
+    def source_text(self):
+        """The exact text this node was parsed from
+
+        For nodes changed since parsing, the serialized node is returned.
+        """
+        if self._source is None:
+            return unicode(self)
+        else:
+            return self._source[self.start:self.end]
+
+    def _verbatim(self):
+        """True if unicode(self) is the same as the source text"""
+        return True
+
+    def _children(self):
+        """All child nodes"""
+        return ()
+
+    def _visited_children(self):
+        """Child nodes that visitors and find() descend into"""
+        return self._children()
+
+    def visit(self, visitor):
+        for child in self._visited_children():
+            visitor(child)
+
+    def _rebase(self, source, delta):
+        """Move this subtree to a new source, shifted by delta characters"""
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if node._source is not None:
+                node._set_span(source, node.start + delta, node.end + delta)
+            nodes.extend(node._children())
+        return self
+
+class Element(Node):
+    """Node that is serialized from its children"""
+    @memoized
     def __unicode__(self):
+        if self._source is not None and self._verbatim():
+            return self._source[self.start:self.end]
+        else:
+            return self._serialize()
+
+class NodeAttributes(Element):
+    """Node whose public attributes hold child nodes"""
+    def __setattr__(self, attr, value):
+        if attr.startswith('_'):
+            object.__setattr__(self, attr, value)
+        else:
+            object.__setattr__(self, attr, self._adopt(value))
+            self.invalidate()
+
+class NodeList(Element, list):
+    """List of child nodes"""
+    def __init__(self, items=()):
+        list.__init__(self, self._adopt_all(items))
+
+    def _adopt_all(self, items):
+        items = list(items)
+        for item in items:
+            self._adopt(item)
+        return items
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = self._adopt_all(value)
+        else:
+            self._adopt(value)
+        list.__setitem__(self, index, value)
+        self.invalidate()
+
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, self._adopt_all(items))
+        self.invalidate()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def append(self, item):
+        list.append(self, self._adopt(item))
+        self.invalidate()
+
+    def insert(self, index, item):
+        list.insert(self, index, self._adopt(item))
+        self.invalidate()
+
+    def extend(self, items):
+        list.extend(self, self._adopt_all(items))
+        self.invalidate()
+
+    def _remover(name):
+        method = getattr(list, name)
+        def remover(self, *args):
+            result = method(self, *args)
+            self.invalidate()
+            return result
+        remover.__name__ = name
+        return remover
+
+    for _name in (b'__delitem__ __delslice__ pop remove reverse sort').split():
+        locals()[_name] = _remover(_name)
+    del _name, _remover
+
+    def _children(self):
+        return self
+
+    @memoized
+    def _verbatim(self):
+        return all(item._verbatim() for item in self)
+
+class Content(NodeList):
+    def _serialize(self):
         return ''.join(unicode(x) for x in self)
 
-    def visit(self, visitor):
-        for item in self:
-            visitor(item)
+    @property
+    @memoized
+    def section_index(self):
+        """Dict of the sections in this tree, keyed by path
+
+        A path is a tuple of the normalized headers leading to the section,
+        e.g. ('Learnset', 'By leveling up'). If two sections have the same
+        path, the first one is indexed.
+        """
+        index = {}
+        def add_sections(node, path):
+            for item in node:
+                if isinstance(item, Section):
+                    header = item.header
+                    if header is None:
+                        item_path = path
+                    else:
+                        item_path = path + (normalize_header(header.name), )
+                        index.setdefault(item_path, item)
+                    add_sections(item, item_path)
+        add_sections(self, ())
+        return index
 
     def dump(self, indent_level=0):
         print '  ' * indent_level + ':'
@@ -97,46 +345,83 @@ class Section(Content):
             item.dump(indent_level + 1)
 
     @property
+    @memoized
     def header(self):
         for element in self:
             if isinstance(element, Header):
                 return element
 
-class String(unicode):
-    def visit(self, visitor):
-        pass
-
+class String(Node, unicode):
     def dump(self, indent_level=0):
         print '  ' * indent_level + "'" + self.replace('\n', r'\n') + "'"
 
-class Template(object):
+class Expansion(String):
+    """The expanded value of a template; `template` is the original node
+
+    The span is that of the original template.
+    Templates transcluded into the value are only text here, so visitors
+    and find() descend into the original template's parameters instead:
+    e.g. an infobox wrapped in an #if is still found as a Template. So are
+    templates in branches that weren't taken.
+    """
+    def _verbatim(self):
+        return False
+
+    def _visited_children(self):
+        return self.template.params
+
+    def dump(self, indent_level=0):
+        print '  ' * indent_level + "{{=" + self.replace('\n', r'\n') + "=}}"
+
+class TemplateParams(NodeList):
+    def _serialize(self):
+        return ' | '.join(unicode(x) for x in self)
+
+class Template(NodeAttributes):
     def __init__(self, name, params):
         self.name = name
-        self.params = params
+        self.params = TemplateParams(params)
 
     @property
+    @memoized
     def string_name(self):
         return make_wikiname(unicode(self.name))
 
     @property
-    def normalized_params(self):
+    @memoized
+    def param_items(self):
+        """List of (name, value) pairs of the parameters, in order
+
+        Positional parameters get numbered names; names and values are
+        stripped. Duplicate names are kept.
+        """
         number = 1
-        normalized = {}
+        items = []
         for param in self.params:
-            if param.name:
-                normalized[unicode(param.name).strip()] = unicode(param.value
-                        ).strip()
+            if param.name is not None:
+                name = unicode(param.name).strip()
             else:
-                normalized[unicode(number)] = unicode(param.value).strip()
+                name = unicode(number)
                 number += 1
-        return normalized
+            items.append((name, unicode(param.value).strip()))
+        return items
 
-    def __unicode__(self):
-        return "{{" + unicode(self.name) + ' | ' + ' | '.join(unicode(x) for x in self.params) + "}}"
+    @property
+    @memoized
+    def normalized_params(self):
+        return dict(self.param_items)
 
-    def visit(self, visitor):
-        for param in self.params:
-            visitor(param)
+    def _verbatim(self):
+        return False
+
+    def _children(self):
+        return [self.name, self.params]
+
+    def _serialize(self):
+        return "{{" + unicode(self.name) + ' | ' + unicode(self.params) + "}}"
+
+    def _visited_children(self):
+        return self.params
 
     def dump(self, indent_level=0):
         print '  ' * indent_level + '{{'
@@ -145,142 +430,1420 @@ class Template(object):
             print '  ' * indent_level + '|'
             param.dump(indent_level + 1)
 
-class TemplateArgument(object):
+class TemplateArgument(NodeAttributes):
     def __init__(self, name, value):
         self.name = name
         self.value = value
 
-    def __unicode__(self):
-        if self.name:
+    @memoized
+    def _verbatim(self):
+        return ((self.name is None or self.name._verbatim()) and
+                self.value._verbatim())
+
+    def _serialize(self):
+        if self.name is not None:
             return unicode(self.name) + '=' + unicode(self.value)
         else:
             return unicode(self.value)
 
-    def visit(self, visitor):
-        if self.name:
-            visitor(self.name)
-        visitor(self.value)
+    def _children(self):
+        if self.name is None:
+            return [self.value]
+        else:
+            return [self.name, self.value]
 
     def dump(self, indent_level=0):
-        if self.name:
+        if self.name is not None:
             self.name.dump(indent_level)
             print '  ' * (indent_level - 1) + '='
         self.value.dump(indent_level)
 
-class Header(object):
+class Header(NodeAttributes):
     def __init__(self, level, name):
         self.name = name
         self.level = level
 
-    def __unicode__(self):
-        return '=' * self.level + unicode(self.name) + '=' * self.level
+    def _verbatim(self):
+        return self.name._verbatim()
 
-    def visit(self, visitor):
-        visitor(self.name)
+    def _children(self):
+        return [self.name]
+
+    def _serialize(self):
+        return '=' * self.level + unicode(self.name) + '=' * self.level
 
     def dump(self, indent_level=0):
         print '  ' * indent_level + '=' * self.level
         self.name.dump(indent_level + 1)
 
+class Table(Content):
+    """A {| ... |} table
+
+    The items are the table's markup, as in any Content. Rows and cells are
+    only picked out of it when iterated over, by rows().
+    """
+    @property
+    def attributes(self):
+        """Text after the opening '{|'"""
+        for line in _lines(self):
+            return _join(line).strip()[2:].strip()
+
+    @property
+    def caption(self):
+        """Text of the '|+' line, or None"""
+        for line in _lines(self):
+            text = _join(line).strip()
+            if text.startswith('|+'):
+                return text[2:].strip()
+            elif text.startswith(('|-', '|}', '|', '!')):
+                return None
+
+    def rows(self):
+        """Generate the rows of the table, as TableRow objects
+
+        Each row is picked out only when it is reached. Cells that come
+        before the first '|-' make up a row of their own.
+        Nested tables are single items in the cells they're in.
+        """
+        row = TableRow()
+        for line in _lines(self):
+            if line and isinstance(line[0], String):
+                first = line[0]
+            else:
+                first = ''
+            text = first.lstrip()
+            indent = len(first) - len(text)
+            marker = text[:2]
+            if marker in ('{|', '|+'):
+                continue
+            elif marker == '|}':
+                break
+            elif marker == '|-':
+                if row.cells or row.attributes is not None:
+                    yield row
+                rest = _after(line, indent + 2)
+                row = TableRow(_join(rest).strip())
+            elif marker[:1] in ('|', '!'):
+                rest = _after(line, indent + 1)
+                parts = _split_items(rest, '||')
+                header = marker[:1] == '!'
+                if header:
+                    parts = [part for items in parts
+                            for part in _split_items(items, '!!')]
+                row.cells.extend(TableCell(header, items) for items in parts)
+            elif row.cells:
+                # Multi-line cell
+                row.cells[-1].items.append(String('\n'))
+                row.cells[-1].items.extend(item for item in line if item != '')
+        if row.cells or row.attributes is not None:
+            yield row
+
+    def dump(self, indent_level=0):
+        print '  ' * indent_level + '{|'
+        for item in self:
+            item.dump(indent_level + 1)
+
+class TableRow(object):
+    """A row of a Table: a list of TableCells, and the row's attributes"""
+    def __init__(self, attributes=None):
+        self.attributes = attributes
+        self.cells = []
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def __len__(self):
+        return len(self.cells)
+
+class TableCell(object):
+    """A cell of a Table
+
+    `items` are the nodes in the cell -- Strings, Templates, nested Tables --
+    shared with the Table. `attributes` is the text before a single '|',
+    or None. `header` is true for '!' cells.
+    """
+    def __init__(self, header, items):
+        self.header = header
+        self.attributes = None
+        if items and isinstance(items[0], String):
+            first = items[0]
+            bar = first.find('|')
+            if bar >= 0 and '[[' not in first[:bar]:
+                self.attributes = first[:bar].strip()
+                items = [_substring(first, bar + 1, len(first))] + items[1:]
+        self.items = [item for item in items if item != '']
+
+    def __unicode__(self):
+        return _join(self.items)
+
+    @property
+    def value(self):
+        """The stripped text of the cell"""
+        return unicode(self).strip()
+
+    @property
+    def templates(self):
+        """The templates directly in the cell"""
+        return [item for item in self.items if isinstance(item, Template)]
+
 ### Parsing
 
 token_re = re.compile(r'({{|\||}}|=)')
+heading_re = re.compile(r'^(=+)(.+)\1(\s*)$', re.MULTILINE)
+
+Event = collections.namedtuple('Event', 'type start end level')
+
+def wikiparse(string, previous=None, expander=None):
+    """Parse a string of wikitext
 
-def wikiparse(string):
-    tokens = token_re.split(string)
-    tree = parse_templates(tokens)
-    #tree = expand_templates(tree)
-    #tree = parse_tables(tree)
+    If `previous` is given, it should be the tree of an earlier version of
+    the text. Top-level sections that did not change are taken over from
+    it rather than reparsed. The previous tree must not be used afterwards.
+    Expansions in the sections taken over are undone, and redone with the
+    `expander`, if any, since the templates may have changed since.
+
+    If an `expander` (an Expander) is given, parser function calls that
+    it can evaluate are replaced by their values; see expand_templates().
+
+    A WikitextWarning is issued for templates that are never closed.
+    """
+    tree = None
+    if previous is not None and previous._source is not None:
+        tree = reparse_sections(string, previous)
+        if tree is not None:
+            unexpand_templates(tree)
+    if tree is None:
+        unclosed = unclosed_templates(string)
+        if unclosed:
+            warnings.warn(WikitextWarning(
+                    'Bad end of template! (%s times) %s' % (len(unclosed),
+                        [string[start:start + 50]
+                            for start in sorted(unclosed)[:3]])),
+                    stacklevel=2)
+        tree = parse_tables(build_tree(string, scan(string,
+                unclosed=unclosed)))
+    if expander is not None:
+        expand_templates(tree, expander)
     tree = do_structure(tree)
     # Inline markup
     # Internal links
     # External links
     return tree
 
-def parse_templates(tokens, end=[]):
-    contents = Content()
-    while tokens:
-        if tokens[0] == '{{':
-            del tokens[0]
-            contents.append(parse_template(tokens))
-        elif tokens[0] in end:
-            return contents
-        else:
-            if contents and isinstance(contents[-1], String):
-                contents[-1] = String(contents[-1] + tokens[0])
+def dump_tree(tree):
+    """Serialize a tree to a string
+
+    Nodes are written as a flat list of numbers, in depth-first order: the
+    class, the span, the number of items of lists, and which attributes are
+    nodes. The source text is written once; Strings whose text is their
+    span of the source are read back from it. Memos are left out.
+    """
+    source = tree._source
+    classes = {}
+    layouts = {(): 0}
+    layout_of_keys = {}
+    codes = []
+    objects = []
+    last_start = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        cls = type(node)
+        try:
+            class_index = classes[cls]
+        except KeyError:
+            class_index = classes[cls] = len(classes)
+        state = node.__dict__
+        keys = tuple(state)
+        try:
+            names, layout = layout_of_keys[keys]
+        except KeyError:
+            names = tuple(sorted(name for name in keys
+                    if name[0] != '_' and name != 'start' and name != 'end'))
+            layout = layouts.setdefault(names, len(layouts))
+            layout_of_keys[keys] = names, layout
+        flags = 0
+        if 'start' in state:
+            flags |= 1
+        if state.get('_source') is not None:
+            flags |= 2
+        children = []
+        if isinstance(node, NodeList):
+            children.extend(node)
+        elif isinstance(node, unicode):
+            if flags & 2 and node == source[node.start:node.end]:
+                flags |= 4
+            else:
+                objects.append(unicode(node))
+        codes.extend((class_index, flags, layout))
+        if flags & 1:
+            start = state['start']
+            codes.extend((start - last_start, state['end'] - start))
+            last_start = start
+        if isinstance(node, NodeList):
+            codes.append(len(node))
+        for name in names:
+            value = state[name]
+            if isinstance(value, Node):
+                codes.append(1)
+                children.append(value)
+            else:
+                codes.append(0)
+                objects.append(value)
+        stack.extend(reversed(children))
+    classes = sorted(classes, key=classes.get)
+    layouts = sorted(layouts, key=layouts.get)
+    return pickle.dumps((source, classes, layouts, codes, objects),
+            pickle.HIGHEST_PROTOCOL)
+
+def load_tree(data):
+    """Load a tree serialized by dump_tree"""
+    source, classes, layouts, codes, objects = pickle.loads(data)
+    # Trees are made of many small objects; the cycle collector would
+    # keep rescanning them while they're being loaded
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        kinds = [issubclass(cls, unicode) and 's' or
+                issubclass(cls, NodeList) and 'l' or 'n' for cls in classes]
+        root = None
+        position = object_position = last_start = 0
+        # (parent, attribute name, or None for list items)
+        slots = [(None, None)]
+        while slots:
+            parent, name = slots.pop()
+            class_index, flags, layout = codes[position:position + 3]
+            position += 3
+            if flags & 1:
+                start = last_start + codes[position]
+                end = start + codes[position + 1]
+                position += 2
+                last_start = start
+            cls = classes[class_index]
+            kind = kinds[class_index]
+            count = 0
+            if kind == 's':
+                if flags & 4:
+                    text = source[start:end]
+                else:
+                    text = objects[object_position]
+                    object_position += 1
+                node = unicode.__new__(cls, text)
+            else:
+                node = cls.__new__(cls)
+                if kind == 'l':
+                    count = codes[position]
+                    position += 1
+            state = node.__dict__
+            if flags & 1:
+                state['start'] = start
+                state['end'] = end
+            if flags & 2:
+                state['_source'] = source
+            if parent is None:
+                root = node
             else:
-                contents.append(String(tokens[0]))
-            del tokens[0]
-    return contents
-
-def parse_template(tokens):
-    # tokens is guaranteed to have '}}' in it
-    name = parse_templates(tokens, end=['}}', '|'])
-    params = parse_template_params(tokens)
-    if params is None:
-        # Oops, it wasn't a template
-        name.insert(0, String('{{'))
-        name.extend(parse_templates(tokens))
-        return name
+                state['_parent'] = parent
+                if name is None:
+                    list.append(parent, node)
+                else:
+                    parent.__dict__[name] = node
+            children = [(node, None)] * count
+            for name in layouts[layout]:
+                if codes[position]:
+                    children.append((node, name))
+                else:
+                    state[name] = objects[object_position]
+                    object_position += 1
+                position += 1
+            slots.extend(reversed(children))
+        return root
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _parse_page(page):
+    title, text = page
+    if text is None:
+        return title, None
     else:
-        return Template(name, params)
-
-def parse_template_params(tokens):
-    args = []
-    tokens_saved = list(tokens)
-    while tokens:
-        if tokens[0] == '}}':
-            del tokens[0]
-            return args
-        elif tokens[0] == '|':
-            del tokens[0]
-            args.append(parse_template_param(tokens))
+        return title, dump_tree(wikiparse(text))
+
+def parse_pages(pages, processes=None, chunksize=8):
+    """Parse many (title, text) pairs in a pool of worker processes
+
+    Returns a list of (title, tree) pairs in the order of `pages`. A text
+    of None (a missing page) gives a tree of None.
+    `processes` defaults to the number of CPUs.
+
+    Workers hand trees back serialized with dump_tree; loading them in this
+    process costs about a third of what parsing does.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_parse_page, pages, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    return [(title, None if data is None else load_tree(data))
+            for title, data in results]
+
+def open_templates(string, start=0, end=None):
+    """Return offsets of '{{' tokens left open at the end of string[start:end]
+
+    Each '}}' closes the innermost open '{{'.
+    """
+    if end is None:
+        end = len(string)
+    open_templates = []
+    for match in token_re.finditer(string, start, end):
+        token = match.group()
+        if token == '{{':
+            open_templates.append(match.start())
+        elif token == '}}' and open_templates:
+            open_templates.pop()
+    return open_templates
+
+class WikitextWarning(UserWarning):
+    """Issued for wikitext that is parsed, but probably not as intended"""
+
+def unclosed_templates(string, start=0, end=None):
+    """Return the set of offsets of '{{' tokens that are never closed
+
+    Whatever is left open at the end of the text is plain text.
+    """
+    return set(open_templates(string, start, end))
+
+def scan(string, start=0, end=None, unclosed=None):
+    """Generate parse events for a string of wikitext
+
+    Yields Event tuples; `start` and `end` are offsets into the string.
+    The event types are:
+
+    - 'text': a run of plain text
+    - 'template_start': the '{{' opening a template
+    - 'param': a '|' starting a template parameter
+    - 'param_value': the '=' separating a parameter's name from its value
+    - 'template_end': the '}}' closing a template
+    - 'heading': a top-level heading line, with `level` set
+
+    Memory use does not depend on the length of the string, only on how
+    deep templates are nested.
+
+    If `start` and `end` are given, only that part of the string is scanned,
+    as if it was the whole text. `unclosed` can give the result of
+    unclosed_templates() for the same part, if it's already known.
+    """
+    if end is None:
+        end = len(string)
+    if unclosed is None:
+        unclosed = unclosed_templates(string, start, end)
+    # One state per open template: 'name', 'param_name' or 'param_value'
+    stack = []
+    text_start = start
+    text_end = end
+    for match in token_re.finditer(string, start, end):
+        token = match.group()
+        start, end = match.span()
+        if token == '{{':
+            if start in unclosed:
+                continue
+            for event in _text_events(string, text_start, start, stack):
+                yield event
+            yield Event('template_start', start, end, None)
+            stack.append('name')
+        elif not stack:
+            continue
+        elif token == '}}':
+            for event in _text_events(string, text_start, start, stack):
+                yield event
+            yield Event('template_end', start, end, None)
+            stack.pop()
+        elif token == '|':
+            for event in _text_events(string, text_start, start, stack):
+                yield event
+            yield Event('param', start, end, None)
+            stack[-1] = 'param_name'
+        elif token == '=' and stack[-1] == 'param_name':
+            for event in _text_events(string, text_start, start, stack):
+                yield event
+            yield Event('param_value', start, end, None)
+            stack[-1] = 'param_value'
         else:
-            raise ValueError(tokens[0], tokens)
-    # No end of template! Backtrace.
-    print 'WIKITEXT PARSE WARNING: Bad end of template!', tokens_saved[:50]
-    tokens[:] = tokens_saved
-    return None
+            continue
+        text_start = end
+    for event in _text_events(string, text_start, text_end, stack):
+        yield event
 
-def parse_template_param(tokens):
-    part1 = parse_templates(tokens, end=['}}', '|', '='])
-    if tokens and tokens[0] == '=':
-        del tokens[0]
-        part2 = parse_templates(tokens, end=['}}', '|'])
-        return TemplateArgument(part1, part2)
+def _text_events(string, start, end, stack):
+    if stack:
+        if start < end:
+            yield Event('text', start, end, None)
     else:
-        return TemplateArgument(None, part1)
+        # only do headings at the top level, not in templates etc.
+        position = 0
+        for match in heading_re.finditer(string[start:end]):
+            if match.start() > position:
+                yield Event('text', start + position, start + match.start(),
+                        None)
+            position = match.start(3)
+            yield Event('heading', start + match.start(), start + position,
+                    len(match.group(1)))
+        if start + position < end:
+            yield Event('text', start + position, end, None)
 
-heading_re = re.compile(r'^(=+)(.+)\1(\s*)$', re.MULTILINE)
+class _TemplateFrame(object):
+    def __init__(self, start, outer_items, outer_start):
+        self.start = start
+        self.outer_items = outer_items
+        self.outer_start = outer_start
+        self.name = None
+        self.params = []
+        self.arg_name = None
+        self.arg_start = None
 
-def do_structure(tree):
-    replaced = Content()
-    # only do headings at the top level, not in templates etc.
-    for item in tree:
+    def add_part(self, content):
+        if self.name is None:
+            self.name = content
+        else:
+            self.params.append(TemplateArgument(self.arg_name, content
+                    )._set_span(content._source, self.arg_start, content.end))
+            self.arg_name = None
+
+def build_tree(source, events, start=0, end=None):
+    """Build a flat parse tree from scan() events
+
+    `start` and `end` should be the ones given to scan().
+    """
+    if end is None:
+        end = len(source)
+    tree_start, tree_end = start, end
+    items = []
+    items_start = start
+    stack = []
+    for event in events:
+        kind, start, end, level = event
+        if kind == 'text':
+            items.append(String(source[start:end])._set_span(
+                    source, start, end))
+        elif kind == 'heading':
+            name = String(source[start + level:end - level])._set_span(
+                    source, start + level, end - level)
+            items.append(Header(level, name)._set_span(source, start, end))
+        elif kind == 'template_start':
+            stack.append(_TemplateFrame(start, items, items_start))
+            items, items_start = [], end
+        else:
+            frame = stack[-1]
+            content = Content(items)._set_span(source, items_start, start)
+            if kind == 'param_value':
+                frame.arg_name = content
+            elif kind == 'param':
+                frame.add_part(content)
+                frame.arg_start = end
+            elif kind == 'template_end':
+                frame.add_part(content)
+                stack.pop()
+                template = Template(frame.name, frame.params)
+                items, items_start = frame.outer_items, frame.outer_start
+                items.append(template._set_span(source, frame.start, end))
+                continue
+            else:
+                raise ValueError(kind)
+            items, items_start = [], end
+    assert not stack
+    return Content(items)._set_span(source, tree_start, tree_end)
+
+def _substring(string, start, end):
+    """Return string[start:end] as a String, with its span if string has one"""
+    piece = String(string[start:end])
+    if string._source is not None:
+        piece._set_span(string._source, string.start + start,
+                string.start + end)
+    return piece
+
+def _join(items):
+    return ''.join(unicode(item) for item in items)
+
+def _split_items(items, separator):
+    """Split a list of items at each separator in their Strings
+
+    Returns a list of lists of items; other nodes are never split.
+    """
+    parts = [[]]
+    for item in items:
+        if isinstance(item, String):
+            position = 0
+            while True:
+                index = item.find(separator, position)
+                if index < 0:
+                    break
+                parts[-1].append(_substring(item, position, index))
+                parts.append([])
+                position = index + len(separator)
+            parts[-1].append(_substring(item, position, len(item)))
+        else:
+            parts[-1].append(item)
+    return parts
+
+def _lines(items):
+    """Generate the lines of a list of items, each a list of items
+
+    The newlines and empty Strings are left out.
+    """
+    line = []
+    for item in items:
         if isinstance(item, String):
-            replaced += parse_headings(item)
+            pieces = _split_items([item], '\n')
+            line.extend(piece for piece in pieces[0] if piece != '')
+            for piece in pieces[1:]:
+                yield line
+                line = [part for part in piece if part != '']
+        else:
+            line.append(item)
+    yield line
+
+def _after(line, length):
+    """Return line without the first `length` characters of its first item"""
+    first = line[0]
+    return [_substring(first, length, len(first))] + line[1:]
+
+table_re = re.compile(r'^[ \t]*(\{\||\|\})', re.MULTILINE)
+
+def _table_markers(items):
+    """Generate (start, end, marker) for the '{|' and '|}' lines in items
+
+    Only Strings directly in items are searched. Headers are generated too,
+    with a marker of None.
+    """
+    for item in items:
+        if isinstance(item, Header):
+            yield item.start, item.end, None
+        elif isinstance(item, String) and item._source is not None:
+            for match in table_re.finditer(item):
+                start = item.start + match.start()
+                if (match.start() or start == 0 or
+                        item._source[start - 1] == '\n'):
+                    yield start, item.start + match.end(), match.group(1)
+
+def _table_spans(items, depth=0):
+    """Find tables in a list of items
+
+    Returns (spans, unclosed): `spans` is a list of (start, end) of the
+    tables nested `depth` deep, and `unclosed` the number of '{|' that are
+    never closed. A '|}' with no open table is plain text.
+    Tables don't span headings: a heading leaves the open tables unclosed.
+    That keeps headings, and so sections, out of tables.
+    """
+    spans = []
+    opened = []
+    unclosed = 0
+    for start, end, marker in _table_markers(items):
+        if marker is None:
+            unclosed += len(opened)
+            opened = []
+        elif marker == '{|':
+            opened.append(start)
+        elif opened:
+            table_start = opened.pop()
+            if len(opened) == depth:
+                spans.append((table_start, end))
+    return spans, unclosed + len(opened)
+
+def _group_tables(items, depth=0):
+    """Return a list of items with the tables grouped into Table nodes
+
+    Strings are split at the start and end of tables.
+    """
+    spans, unclosed = _table_spans(items, depth)
+    if not spans:
+        return list(items)
+    boundaries = sorted(position for span in spans for position in span)
+    spans = collections.deque(spans)
+    result = []
+    table_items = None
+    for item in items:
+        if isinstance(item, String):
+            first = bisect.bisect_right(boundaries, item.start)
+            last = bisect.bisect_left(boundaries, item.end)
+            cuts = [0] + [position - item.start
+                    for position in boundaries[first:last]] + [len(item)]
+            pieces = [_substring(item, start, end)
+                    for start, end in zip(cuts, cuts[1:])]
+        else:
+            pieces = [item]
+        for piece in pieces:
+            if table_items is None:
+                if spans and piece.start >= spans[0][0]:
+                    table_items = []
+                else:
+                    result.append(piece)
+                    continue
+            table_items.append(piece)
+            if piece.end >= spans[0][1]:
+                start, end = spans.popleft()
+                result.append(Table(_group_tables(table_items, depth=1)
+                        )._set_span(piece._source, start, end))
+                table_items = None
+    return result
+
+def parse_tables(tree):
+    """Group the top-level tables of a flat tree into Table nodes
+
+    Tables are found by their '{|' and '|}' lines; those inside templates
+    are left alone, and so are tables that would span a heading. Rows and cells are not parsed until they're asked for;
+    see Table.rows().
+    """
+    return Content(_group_tables(tree))._set_span(
+            tree._source, tree.start, tree.end)
+
+def flatten_sections(tree):
+    """Yield the top-level items of a structured tree, in order"""
+    for item in tree:
+        if isinstance(item, Section):
+            for subitem in flatten_sections(item):
+                yield subitem
         else:
-            replaced.append(item)
+            yield item
+
+def _top_level_segments(tree):
+    """Split top-level items to segments, each starting with a Header
+
+    Returns a list of (start, end, items); the first segment, which holds
+    whatever comes before the first heading, may not start with a Header.
+    """
+    segments = [(tree.start, [])]
+    for item in flatten_sections(tree):
+        if isinstance(item, Header):
+            segments.append((item.start, []))
+        segments[-1][1].append(item)
+    ends = [start for start, items in segments[1:]] + [tree.end]
+    return [(start, end, items) for (start, items), end
+            in zip(segments, ends)]
+
+def _is_heading_start(string, position):
+    """True if a top-level heading can start at position in string"""
+    if position > 0 and string[position - 1] != '\n':
+        return False
+    return bool(heading_re.match(string, position))
+
+def reparse_sections(string, previous):
+    """Parse string, reusing the unchanged top-level sections of `previous`
+
+    Returns a flat tree like build_tree(), or None if the unchanged parts
+    can't be reused, e.g. because a template spans the changed boundary.
+    """
+    old_string = previous._source
+    if old_string == string:
+        return Content(flatten_sections(previous))._set_span(
+                string, 0, len(string))
+    segments = _top_level_segments(previous)
+    delta = len(string) - len(old_string)
+
+    # Unchanged segments at the start...
+    num_prefix = 0
+    for start, end, items in segments:
+        if string[start:end] != old_string[start:end]:
+            break
+        num_prefix += 1
+    while num_prefix and not _is_heading_start(string,
+            segments[num_prefix - 1][1]):
+        num_prefix -= 1
+    if num_prefix:
+        changed_start = segments[num_prefix - 1][1]
+    else:
+        changed_start = 0
+
+    # ... and at the end
+    first_suffix = len(segments)
+    for start, end, items in reversed(segments[num_prefix:]):
+        new_start = start + delta
+        if (new_start < changed_start or
+                string[new_start:end + delta] != old_string[start:end]):
+            break
+        first_suffix -= 1
+    while first_suffix < len(segments) and not (
+            segments[first_suffix][0] > 0 and
+            _is_heading_start(old_string, segments[first_suffix][0]) and
+            _is_heading_start(string, segments[first_suffix][0] + delta)):
+        first_suffix += 1
+    if first_suffix == len(segments):
+        changed_end = len(string)
+    else:
+        changed_end = segments[first_suffix][0] + delta
+
+    # Each part must be self-contained
+    for start, end in ((0, changed_start), (changed_start, changed_end),
+            (changed_end, len(string))):
+        if open_templates(string, start, end):
+            return None
+
+    prefix = []
+    for start, end, segment_items in segments[:num_prefix]:
+        for item in segment_items:
+            prefix.append(item._rebase(string, 0))
+    changed = parse_tables(build_tree(string,
+            scan(string, changed_start, changed_end),
+            changed_start, changed_end))
+    suffix = []
+    for start, end, segment_items in segments[first_suffix:]:
+        for item in segment_items:
+            suffix.append(item._rebase(string, delta))
+    # Tables don't span headings, so those of each part are as in a full parse
+    return Content(prefix + list(changed) + suffix)._set_span(
+            string, 0, len(string))
+
+def do_structure(tree):
     root = Content()
     first_section = Section()
     section_stack = [root, first_section]
+    sections = [first_section]
     root.append(first_section)
-    for item in replaced:
+    for item in tree:
         if isinstance(item, Header):
             while item.level < len(section_stack):
                 section_stack.pop()
             while item.level >= len(section_stack):
                 section_stack.append(Section())
                 section_stack[-2].append(section_stack[-1])
+                sections.append(section_stack[-1])
         section_stack[-1].append(item)
+    # Subsections come after their parents, so set spans in reverse order
+    for section in reversed(sections):
+        if section:
+            section._set_span(tree._source, section[0].start, section[-1].end)
+        else:
+            section._set_span(tree._source, tree.start, tree.start)
+    root.section_index  # build the index now; it's memoized
+    return root._set_span(tree._source, tree.start, tree.end)
+
+### Template expansion
+
+class Unexpandable(Exception):
+    """Raised for wikitext that the Expander can't evaluate
+
+    E.g. magic words and parser functions like #time, whose value depends
+    on when or where the page is shown, or missing templates.
+    """
+
+_Transclusion = collections.namedtuple('_Transclusion', 'kind parts')
+
+preprocess_re = re.compile(r'({{+|}}+|\[\[|\]\]|\|)')
+comment_re = re.compile(r'<!--.*?(-->|\Z)', re.DOTALL)
+noinclude_re = re.compile(r'<noinclude>.*?(</noinclude>|\Z)', re.DOTALL)
+onlyinclude_re = re.compile(r'<onlyinclude>(.*?)</onlyinclude>', re.DOTALL)
+includeonly_re = re.compile(r'</?includeonly>')
+redirect_re = re.compile(r'#REDIRECT *\[\[([^\]|]+)\]\]', re.IGNORECASE)
+
+class _BraceFrame(object):
+    def __init__(self, kind, count):
+        self.kind = kind
+        self.count = count
+        self.parts = [[]]
+
+    def literal(self):
+        """The frame's text and nodes, when it turns out not to be closed"""
+        opening = '[[' if self.kind == 'link' else '{' * self.count
+        pieces = [opening]
+        for i, part in enumerate(self.parts):
+            if i:
+                pieces.append('|')
+            pieces.extend(part)
+        return pieces
+
+def preprocess(text):
+    """Split wikitext into text and transclusions, for expansion
+
+    Returns a list of pieces: unicode strings, and _Transclusion tuples for
+    templates ('template') and template arguments ('argument', {{{...}}}).
+    A transclusion's `parts` are lists of pieces, split at each '|'.
+
+    Braces are matched the way MediaWiki does it, so that e.g. '{{{{{1}}}}}'
+    is a template named by an argument. A '|' inside [[...]] is not a
+    separator.
+    """
+    root = []
+    stack = []
+    def current():
+        if stack:
+            return stack[-1].parts[-1]
+        else:
+            return root
+    position = 0
+    for match in preprocess_re.finditer(text):
+        if match.start() > position:
+            current().append(text[position:match.start()])
+        position = match.end()
+        token = match.group()
+        top = stack[-1] if stack else None
+        if token == '[[':
+            stack.append(_BraceFrame('link', 2))
+        elif token == '{' * len(token):
+            stack.append(_BraceFrame('braces', len(token)))
+        elif token == '|':
+            if top is None:
+                current().append(token)
+            elif top.kind == 'link':
+                current().append(token)
+            else:
+                top.parts.append([])
+        elif token == ']]':
+            if top is not None and top.kind == 'link':
+                stack.pop()
+                current().extend(top.literal() + [']]'])
+            else:
+                current().append(token)
+        else:
+            count = len(token)
+            while count >= 2 and stack and stack[-1].kind == 'braces':
+                frame = stack[-1]
+                if count >= 3 and frame.count >= 3:
+                    used, kind = 3, 'argument'
+                else:
+                    used, kind = 2, 'template'
+                node = _Transclusion(kind, frame.parts)
+                frame.count -= used
+                count -= used
+                if frame.count >= 2:
+                    # More braces were opened here; the rest is still open
+                    frame.parts = [[node]]
+                else:
+                    stack.pop()
+                    if frame.count:
+                        current().append('{' * frame.count)
+                    current().append(node)
+            if count:
+                current().append('}' * count)
+    if position < len(text):
+        current().append(text[position:])
+    while stack:
+        frame = stack.pop()
+        current().extend(frame.literal())
     return root
 
-def parse_headings(string):
-    split = heading_re.split(string)
-    result = Content([String(split[0])])
-    del split[0]
-    while split:
-        result.append(Header(len(split[0]), String(split[1])))
-        result.append(String(split[2] + split[3]))
-        del split[:4]
-    return result
+def _split_equals(part):
+    """Split a part into (name, value) at its first '=', or return None
+
+    Only '=' in the part's own text count, not ones in nested templates.
+    """
+    for i, piece in enumerate(part):
+        if isinstance(piece, unicode) and '=' in piece:
+            before, equals, after = piece.partition('=')
+            return part[:i] + [before], [after] + part[i + 1:]
+    return None
+
+def _included_text(text):
+    """The part of a template page's text that gets transcluded"""
+    text = comment_re.sub('', text)
+    only = onlyinclude_re.findall(text)
+    if only:
+        text = ''.join(only)
+    text = noinclude_re.sub('', text)
+    return includeonly_re.sub('', text)
+
+# Variables that look like templates; they can't be expanded here
+magic_words = frozenset("""
+        ! PAGENAME PAGENAMEE FULLPAGENAME FULLPAGENAMEE BASEPAGENAME
+        BASEPAGENAMEE SUBPAGENAME SUBPAGENAMEE ROOTPAGENAME TALKPAGENAME
+        SUBJECTPAGENAME ARTICLEPAGENAME NAMESPACE NAMESPACEE NAMESPACENUMBER
+        TALKSPACE SUBJECTSPACE ARTICLESPACE
+        CURRENTYEAR CURRENTMONTH CURRENTMONTH1 CURRENTMONTH2 CURRENTMONTHNAME
+        CURRENTMONTHNAMEGEN CURRENTMONTHABBREV CURRENTDAY CURRENTDAY2
+        CURRENTDOW CURRENTDAYNAME CURRENTTIME CURRENTHOUR CURRENTWEEK
+        CURRENTTIMESTAMP
+        LOCALYEAR LOCALMONTH LOCALMONTH1 LOCALMONTH2 LOCALMONTHNAME
+        LOCALMONTHNAMEGEN LOCALMONTHABBREV LOCALDAY LOCALDAY2 LOCALDOW
+        LOCALDAYNAME LOCALTIME LOCALHOUR LOCALWEEK LOCALTIMESTAMP
+        SITENAME SERVER SERVERNAME SCRIPTPATH STYLEPATH CURRENTVERSION
+        CONTENTLANGUAGE CONTENTLANG DIRECTIONMARK DIRMARK
+        REVISIONID REVISIONDAY REVISIONDAY2 REVISIONMONTH REVISIONMONTH1
+        REVISIONYEAR REVISIONTIMESTAMP REVISIONUSER REVISIONSIZE PAGEID
+        PAGESIZE NUMBEROFPAGES NUMBEROFARTICLES NUMBEROFFILES NUMBEROFEDITS
+        NUMBEROFVIEWS NUMBEROFUSERS NUMBEROFACTIVEUSERS NUMBEROFADMINS
+        DISPLAYTITLE DEFAULTSORT
+    """.split())
+
+def _template_title(name):
+    """Return the title of the page {{name}} transcludes
+
+    Or None if it's a magic word, or not in the template namespace.
+    All-caps names like {{TM}} are templates, unless they're magic_words.
+    """
+    if not name or name in magic_words or (
+            ':' in name and not name.startswith('Template:')):
+        return None
+    if not name.startswith('Template:'):
+        name = 'Template:' + make_wikiname(name)
+    return name
+
+def _transcluded_templates(pieces, in_functions=False):
+    """Generate titles of the templates transcluded in preprocessed text
+
+    If `in_functions` is true, only those within parser function calls are
+    generated. Templates whose names are computed are left out.
+    """
+    stack = [(pieces, not in_functions)]
+    while stack:
+        pieces, wanted = stack.pop()
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                continue
+            inside = wanted
+            if piece.kind == 'template':
+                name = piece.parts[0]
+                function, colon, rest = (name[0].partition(':')
+                        if name and isinstance(name[0], unicode) else ('', '', ''))
+                if colon and function.strip().startswith('#'):
+                    inside = True
+                elif wanted and all(isinstance(p, unicode) for p in name):
+                    title = _template_title(''.join(name).strip())
+                    if title:
+                        yield title
+            for part in piece.parts:
+                stack.append((part, inside))
+
+class Expander(object):
+    """Evaluates templates and a few parser functions
+
+    Supported are #if, #ifeq, #switch and #expr, and templates transcluded
+    from a WikiCache, if `cache` is given. Anything else -- magic words,
+    other parser functions -- is Unexpandable.
+
+    Only template pages that are up to date in the cache are used; nothing
+    is fetched while expanding. Call prefetch() with the pages to be parsed
+    first, so their templates are fetched in a few batched requests.
+
+    Template pages are preprocessed once, and expansions are memoized by
+    template, revision and arguments, so one Expander should be shared by
+    all articles being checked. The titles of the template pages each
+    expansion used are kept along, for recording(). Only the `memo_size`
+    most recently used expansions and texts are kept.
+    """
+    max_depth = 40
+    memo_size = 10000
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        # title -> (titles of the pages used, including redirects,
+        #   (revision, preprocessed text) or None for unavailable pages)
+        self._templates = {}
+        # (title, revision, arguments) -> (text or None if unexpandable,
+        #   titles of the template pages used); least recent first
+        self._expansions = collections.OrderedDict()
+        # text -> (expanded text or None, titles of the template pages used);
+        #   least recent first
+        self._texts = collections.OrderedDict()
+        # Sets of titles being recorded
+        self._recordings = []
+
+    def prefetch(self, titles):
+        """Bring the templates that pages with `titles` may expand up to date
+
+        These are the templates transcluded in the pages' parser function
+        calls, the templates those transclude, and so on.
+        """
+        wanted = set()
+        for title in titles:
+            text = self.cache.get_cached_content(title)
+            if '#' in text:
+                wanted.update(_transcluded_templates(preprocess(text),
+                        in_functions=True))
+        seen = set()
+        while wanted:
+            self.cache.prefetch_pages(wanted)
+            seen.update(wanted)
+            transcluded = set()
+            for title in wanted:
+                text = self.cache.get_cached_content(title)
+                redirect = redirect_re.match(text)
+                if redirect:
+                    transcluded.add(make_wikiname(redirect.group(1)))
+                else:
+                    transcluded.update(_transcluded_templates(
+                            preprocess(_included_text(text))))
+            wanted = transcluded - seen
+
+    def template_revision(self, title):
+        """Revision of a template page as expansions see it
+
+        That's 0 for missing pages, and None for pages not up to date.
+        """
+        if self.cache.is_up_to_date(title):
+            return self.cache.get_revision(title)
+        return None
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Collect the titles of the template pages used within the block
+
+        Gives a set of the titles. Pages used by memoized expansions are
+        included.
+        """
+        used = set()
+        self._recordings.append(used)
+        try:
+            yield used
+        finally:
+            self._recordings.pop()
+
+    def _record(self, titles):
+        for used in self._recordings:
+            used.update(titles)
+
+    def _recall(self, memo, key):
+        """Return a memoized value, making it the most recent"""
+        value = memo.pop(key)
+        memo[key] = value
+        return value
+
+    def _remember(self, memo, key, value):
+        memo[key] = value
+        while len(memo) > self.memo_size:
+            memo.popitem(last=False)
+
+    def expand(self, text):
+        """Return wikitext with all templates and parser functions expanded
+
+        Raises Unexpandable if it contains something that can't be expanded.
+        """
+        try:
+            result, used = self._recall(self._texts, text)
+        except KeyError:
+            with self.recording() as used:
+                try:
+                    result = self._expand(preprocess(text), {}, ())
+                except Unexpandable:
+                    result = None
+            self._remember(self._texts, text, (result, frozenset(used)))
+        self._record(used)
+        if result is None:
+            raise Unexpandable(text)
+        return result
+
+    def _expand(self, pieces, arguments, stack):
+        result = []
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                result.append(piece)
+            elif piece.kind == 'argument':
+                result.append(self._argument(piece.parts, arguments, stack))
+            else:
+                result.append(self._template(piece.parts, arguments, stack))
+        return ''.join(result)
+
+    def _argument(self, parts, arguments, stack):
+        name = self._expand(parts[0], arguments, stack).strip()
+        try:
+            return arguments[name]
+        except KeyError:
+            if len(parts) > 1:
+                return self._expand(parts[1], arguments, stack)
+            else:
+                return '{{{%s}}}' % name
+
+    def _template(self, parts, arguments, stack):
+        name = self._expand(parts[0], arguments, stack)
+        if len(stack) >= self.max_depth:
+            raise Unexpandable(name)
+        function, colon, first = name.partition(':')
+        function = function.strip()
+        if colon and function.startswith('#'):
+            try:
+                method = getattr(self, '_function_' + function[1:].lower())
+            except AttributeError:
+                raise Unexpandable(function)
+            expand = lambda part: self._expand(part, arguments, stack).strip()
+            return method(first.strip(), parts[1:], expand)
+        else:
+            return self._transclude(name.strip(), parts[1:], arguments, stack)
+
+    def _transclude(self, name, parts, arguments, stack):
+        title = _template_title(name)
+        if self.cache is None or title is None:
+            # Magic word, or not in the template namespace
+            raise Unexpandable(name)
+        name = title
+        if name in stack:
+            raise Unexpandable(name)
+        template_arguments = {}
+        number = 1
+        for part in parts:
+            split = _split_equals(part)
+            if split is None:
+                template_arguments[unicode(number)] = self._expand(
+                        part, arguments, stack)
+                number += 1
+            else:
+                key, value = split
+                key = self._expand(key, arguments, stack).strip()
+                template_arguments[key] = self._expand(
+                        value, arguments, stack).strip()
+        revision, body = self._template_page(name)
+        key = name, revision, tuple(sorted(template_arguments.items()))
+        try:
+            result, used = self._recall(self._expansions, key)
+        except KeyError:
+            with self.recording() as used:
+                try:
+                    result = self._expand(body, template_arguments,
+                            stack + (name, ))
+                except Unexpandable:
+                    result = None
+            self._remember(self._expansions, key,
+                    (result, frozenset(used)))
+        self._record(used)
+        if result is None:
+            raise Unexpandable(name)
+        return result
+
+    def _template_page(self, title, redirects=5):
+        """Return (revision, preprocessed text) of a template page"""
+        try:
+            used, page = self._templates[title]
+        except KeyError:
+            with self.recording() as used:
+                self._record([title])
+                if self.cache.is_up_to_date(title):
+                    text = self.cache.get(title)
+                else:
+                    text = None
+                redirect = None if text is None else redirect_re.match(text)
+                if text is None:
+                    page = None
+                elif redirect and redirects:
+                    try:
+                        page = self._template_page(
+                                make_wikiname(redirect.group(1)),
+                                redirects - 1)
+                    except Unexpandable:
+                        page = None
+                else:
+                    page = (self.cache.get_revision(title),
+                            preprocess(_included_text(text)))
+            self._templates[title] = frozenset(used), page
+        self._record(used)
+        if page is None:
+            raise Unexpandable(title)
+        return page
+
+    # Parser functions. Each gets the text after the ':', the rest of the
+    # parts (unexpanded), and a function to expand a part.
+
+    def _function_if(self, test, parts, expand):
+        if test:
+            return expand(parts[0]) if len(parts) > 0 else ''
+        else:
+            return expand(parts[1]) if len(parts) > 1 else ''
+
+    def _function_ifeq(self, first, parts, expand):
+        if not parts:
+            return ''
+        if _switch_equal(first, expand(parts[0])):
+            return expand(parts[1]) if len(parts) > 1 else ''
+        else:
+            return expand(parts[2]) if len(parts) > 2 else ''
+
+    def _function_switch(self, value, parts, expand):
+        found = False
+        default = None
+        for i, part in enumerate(parts):
+            split = _split_equals(part)
+            if split is None:
+                if i == len(parts) - 1:
+                    # The last case without '=' is the default
+                    return expand(part)
+                if _switch_equal(value, expand(part)):
+                    found = True
+            else:
+                key, result = split
+                key = expand(key)
+                if found or _switch_equal(value, key):
+                    return expand(result)
+                elif key == '#default':
+                    default = result
+        if default is None:
+            return ''
+        else:
+            return expand(default)
+
+    def _function_expr(self, expression, parts, expand):
+        return evaluate_expr(expression)
+
+def _switch_equal(a, b):
+    """Compare like #switch does: as numbers if both are numbers"""
+    if a == b:
+        return True
+    try:
+        return float(a) == float(b)
+    except ValueError:
+        return False
+
+expr_token_re = re.compile(r'\s*(?:(\d+\.?\d*(?:e[+-]?\d+)?|\.\d+)|'
+        r'(<>|!=|<=|>=|[-+*/^()=<>]|[a-z]+))', re.IGNORECASE)
+
+# Binary operators by precedence, lowest first
+expr_binary = [
+        ('or', ),
+        ('and', ),
+        ('=', '<>', '!=', '<', '>', '<=', '>='),
+        ('round', ),
+        ('+', '-'),
+        ('*', '/', 'div', 'mod'),
+        ('^', ),
+    ]
+expr_unary = {
+        'not': lambda x: float(not x),
+        'abs': abs,
+        'floor': math.floor,
+        'ceil': math.ceil,
+        'trunc': lambda x: float(int(x)),
+    }
+
+def _expr_operate(operator, a, b):
+    if operator == 'or':
+        return float(bool(a or b))
+    elif operator == 'and':
+        return float(bool(a and b))
+    elif operator == '=':
+        return float(a == b)
+    elif operator in ('<>', '!='):
+        return float(a != b)
+    elif operator == '<':
+        return float(a < b)
+    elif operator == '>':
+        return float(a > b)
+    elif operator == '<=':
+        return float(a <= b)
+    elif operator == '>=':
+        return float(a >= b)
+    elif operator == 'round':
+        return round(a, int(b))
+    elif operator == '+':
+        return a + b
+    elif operator == '-':
+        return a - b
+    elif operator == '*':
+        return a * b
+    elif operator in ('/', 'div'):
+        return a / b
+    elif operator == 'mod':
+        # Integer remainder, with the sign of a
+        return math.fmod(int(a), int(b))
+    elif operator == '^':
+        return a ** b
+
+def evaluate_expr(expression):
+    """Evaluate a #expr expression, returning the result as text
+
+    Numbers, + - * / div mod ^ round, comparisons, and/or/not, abs, floor,
+    ceil, trunc and parentheses are supported.
+    Raises Unexpandable for anything else, and for errors.
+    """
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = expr_token_re.match(expression, position)
+        if not match:
+            raise Unexpandable(expression)
+        number, operator = match.groups()
+        if number is not None:
+            tokens.append(float(number))
+        else:
+            tokens.append(operator.lower())
+        position = match.end()
+    if not tokens:
+        return ''
+    tokens.append(None)
+    tokens.reverse()
+
+    def parse_binary(level):
+        if level == len(expr_binary):
+            return parse_unary()
+        value = parse_binary(level + 1)
+        while tokens[-1] in expr_binary[level]:
+            operator = tokens.pop()
+            operand = parse_binary(level + 1)
+            value = _expr_operate(operator, value, operand)
+        return value
+
+    def parse_unary():
+        token = tokens.pop()
+        if token == '-':
+            return -parse_unary()
+        elif token == '+':
+            return parse_unary()
+        elif token == '(':
+            value = parse_binary(0)
+            if tokens.pop() != ')':
+                raise Unexpandable(expression)
+            return value
+        elif isinstance(token, float):
+            return token
+        else:
+            function = expr_unary.get(token)
+            if function is None:
+                raise Unexpandable(expression)
+            return function(parse_unary())
+
+    try:
+        value = parse_binary(0)
+    except (ArithmeticError, ValueError, IndexError):
+        raise Unexpandable(expression)
+    if tokens != [None]:
+        raise Unexpandable(expression)
+    if value == int(value) and abs(value) < 1e15:
+        return unicode(int(value))
+    return '%.14g' % value
+
+def unexpand_templates(tree):
+    """Put the original templates of a tree's Expansion nodes back"""
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, NodeList):
+            for index, item in enumerate(node):
+                if isinstance(item, Expansion):
+                    template = item.template
+                    if item._source is not None:
+                        template._rebase(item._source,
+                                item.start - template.start)
+                    list.__setitem__(node, index, node._adopt(template))
+                    node._forget_memos()
+                else:
+                    nodes.append(item)
+        else:
+            nodes.extend(node._children())
+    return tree
+
+def expand_templates(tree, expander):
+    """Replace parser function calls in a tree by their values
+
+    Calls that the expander can evaluate become Expansion nodes; others are
+    left alone, and so is their content. Other templates are kept, but
+    parser functions in their parameters are expanded.
+    Spans are kept, so source_text still gives the original text.
+    """
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, NodeList):
+            for index, item in enumerate(node):
+                if (isinstance(item, Template) and
+                        unicode(item.name).lstrip().startswith('#')):
+                    try:
+                        value = expander.expand(item.source_text)
+                    except Unexpandable:
+                        continue
+                    expansion = Expansion(value)
+                    expansion.template = item
+                    if item._source is not None:
+                        expansion._set_span(item._source, item.start,
+                                item.end)
+                    list.__setitem__(node, index, node._adopt(expansion))
+                    node._forget_memos()
+                else:
+                    nodes.append(item)
+        else:
+            nodes.extend(node._children())
+    return tree
@@ -0,0 +1,180 @@
+# Encoding: UTF-8
+from __future__ import unicode_literals
+
+import random
+import unittest
+import warnings
+
+from pokemwdb import wikiparse
+
+def shape(node):
+    """Comparable summary of a tree: node types, spans and text"""
+    if isinstance(node, wikiparse.Template):
+        return ('template', node.start, node.end, shape(node.name),
+                [shape(param) for param in node.params])
+    elif isinstance(node, wikiparse.TemplateArgument):
+        return ('argument', node.start, node.end,
+                None if node.name is None else shape(node.name),
+                shape(node.value))
+    elif isinstance(node, wikiparse.Header):
+        return ('header', node.level, node.start, node.end, shape(node.name))
+    elif isinstance(node, list):
+        return (type(node).__name__, node.start, node.end,
+                [shape(item) for item in node])
+    else:
+        return ('string', node.start, node.end, unicode(node))
+
+def count_tables(node):
+    count = int(isinstance(node, wikiparse.Table))
+    if isinstance(node, list):
+        count += sum(count_tables(item) for item in node)
+    return count
+
+class ReparseTest(unittest.TestCase):
+    pieces = ['\n{|', '\n|}', '\n| c || d', '\n|-', '{{', '}}', '|', '=',
+            'a', '\n', '\n== h ==\n', '\n=x=\n', '\n=== s ===\n',
+            '{{t|a=b}}', '{{t|\n== in ==\n}}', 'x=y']
+
+    def assertSameParse(self, old, new):
+        full = wikiparse.wikiparse(new)
+        incremental = wikiparse.wikiparse(new,
+                previous=wikiparse.wikiparse(old))
+        self.assertEqual(shape(incremental), shape(full), (old, new))
+        self.assertEqual(incremental.section_index.keys(),
+                full.section_index.keys())
+
+    def test_table_pairing_changed_elsewhere(self):
+        old = '==A==\n{|\n==B==\n{|\n|x\n|}\n'
+        new = '==A==\nedited\n==B==\n{|\n|x\n|}\n'
+        self.assertSameParse(old, new)
+        self.assertEqual(count_tables(wikiparse.wikiparse(new)), 1)
+
+    def test_random_edits(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', wikiparse.WikitextWarning)
+            rng = random.Random(34)
+            for i in range(2000):
+                old = ''.join(rng.choice(self.pieces)
+                        for j in range(rng.randint(0, 25)))
+                lines = old.split('\n')
+                position = rng.randrange(len(lines))
+                lines[position] += rng.choice(self.pieces)
+                if rng.random() < 0.3:
+                    lines.insert(rng.randrange(len(lines) + 1),
+                            rng.choice(self.pieces))
+                self.assertSameParse(old, '\n'.join(lines))
+
+class FakeCache(object):
+    """Just enough of a WikiCache for an Expander"""
+    def __init__(self, pages):
+        self.pages = pages
+
+    def is_up_to_date(self, title):
+        return True
+
+    def get(self, title):
+        return self.pages.get(title)
+
+    def get_revision(self, title):
+        return hash(self.pages.get(title, ''))
+
+    def get_cached_content(self, title):
+        return self.pages.get(title, '')
+
+    def prefetch_pages(self, titles):
+        pass
+
+class ReparseExpansionTest(unittest.TestCase):
+    old = '== A ==\n{{#if: x | {{Foo}} }}\n== B ==\nold\n'
+    new = '== A ==\n{{#if: x | {{Foo}} }}\n== B ==\nnew\n'
+
+    def expander(self, value):
+        return wikiparse.Expander(FakeCache({'Template:Foo': value}))
+
+    def test_reused_sections_are_expanded_again(self):
+        previous = wikiparse.wikiparse(self.old, expander=self.expander('1'))
+        self.assertIn('1', unicode(previous))
+        tree = wikiparse.wikiparse(self.new, previous,
+                expander=self.expander('2'))
+        full = wikiparse.wikiparse(self.new, expander=self.expander('2'))
+        self.assertEqual(shape(tree), shape(full))
+        self.assertIn('2', unicode(tree))
+        self.assertEqual(tree.source_text, self.new)
+
+    def test_reused_sections_without_expander(self):
+        previous = wikiparse.wikiparse(self.old, expander=self.expander('1'))
+        tree = wikiparse.wikiparse(self.new, previous)
+        self.assertEqual(shape(tree), shape(wikiparse.wikiparse(self.new)))
+
+class ExpandTemplatesTest(unittest.TestCase):
+    def expander(self):
+        return wikiparse.Expander(FakeCache({
+                'Template:TM': 'tm', 'Template:Infobox': 'box'}))
+
+    def test_all_caps_template(self):
+        tree = wikiparse.wikiparse('{{#if: x | {{TM}} }}',
+                expander=self.expander())
+        self.assertEqual(unicode(tree), 'tm')
+
+    def test_magic_word(self):
+        self.assertRaises(wikiparse.Unexpandable,
+                self.expander().expand, '{{PAGENAME}}')
+
+    def test_templates_in_expansions_are_found(self):
+        tree = wikiparse.wikiparse('{{#if: x | {{Infobox|a=b}} }}',
+                expander=self.expander())
+        self.assertEqual(unicode(tree), 'box')
+        infobox = wikiparse.find(tree, wikiparse.Template,
+                lambda t: t.string_name == 'Infobox')
+        self.assertEqual(infobox.source_text, '{{Infobox|a=b}}')
+
+class TableTest(unittest.TestCase):
+    def test_headings_stay_out_of_tables(self):
+        tree = wikiparse.wikiparse('{|\n|a\n== X ==\n|b\n|}\n== Y ==\n')
+        self.assertEqual(sorted(tree.section_index), [('X', ), ('Y', )])
+        self.assertEqual(count_tables(tree), 0)
+
+    def test_table(self):
+        tree = wikiparse.wikiparse('== X ==\n{|\n|a || b\n|-\n|c\n|}\n')
+        self.assertEqual(count_tables(tree), 1)
+        self.assertEqual(sorted(tree.section_index), [('X', )])
+
+class DumpTreeTest(unittest.TestCase):
+    text = ''.join('== S{0} ==\n{{{{t|a={0}|b}}}} text\n'
+            '{{|\n|a || b\n|-\n|c\n|}}\n'.format(i) for i in range(100))
+
+    def test_round_trip(self):
+        tree = wikiparse.wikiparse(self.text)
+        loaded = wikiparse.load_tree(wikiparse.dump_tree(tree))
+        self.assertEqual(shape(loaded), shape(tree))
+        self.assertEqual(loaded.source_text, self.text)
+        self.assertEqual(loaded.section_index.keys(),
+                tree.section_index.keys())
+
+    def test_round_trip_with_expansions(self):
+        expander = wikiparse.Expander(FakeCache({'Template:Foo': '1'}))
+        text = ReparseExpansionTest.old
+        tree = wikiparse.wikiparse(text, expander=expander)
+        loaded = wikiparse.load_tree(wikiparse.dump_tree(tree))
+        self.assertEqual(shape(loaded), shape(tree))
+        self.assertEqual(unicode(loaded), unicode(tree))
+        new = ReparseExpansionTest.new
+        self.assertEqual(shape(wikiparse.wikiparse(new, loaded)),
+                shape(wikiparse.wikiparse(new)))
+
+    def test_size(self):
+        data = wikiparse.dump_tree(wikiparse.wikiparse(self.text))
+        self.assertLess(len(data), 8 * len(self.text.encode('utf-8')))
+
+class WarningTest(unittest.TestCase):
+    def test_unclosed_template(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            list(wikiparse.scan('a {{b c'))
+            self.assertEqual(caught, [])
+            wikiparse.wikiparse('a {{b c')
+            self.assertEqual([w.category for w in caught],
+                    [wikiparse.WikitextWarning])
+
+if __name__ == '__main__':
+    unittest.main()